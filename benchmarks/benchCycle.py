@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+""" Time complete selectNewEpisodes() cycles against the local stub upstream
+(stubUpstream.py) and stub transmission daemon (stubTransmission.py) with
+synthetic SHOWS lists of increasing size.
+
+Every run starts from an empty database, so the first cycle downloads
+everything that matches and the second cycle (same listings) exercises
+the steady state where everything is already selected.
+
+Usage: python3 benchmarks/benchCycle.py [--sizes 10 100 1000 10000]
+           [--providers scrape api] [--latency S] [--error-rate R]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import getTV  # noqa: E402
+import webScrapeFetch  # noqa: E402
+import stubUpstream  # noqa: E402
+import stubTransmission  # noqa: E402
+from benchSelection import controller, syntheticShows  # noqa: E402
+from transmissionRpc import TransmissionClient  # noqa: E402
+
+
+def cycle(runner, verbose):
+    start = time.perf_counter()
+    if verbose:
+        runner.selectNewEpisodes()
+    else:
+        with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+            runner.selectNewEpisodes()
+
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--providers", nargs="+", default=["scrape"])
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    upstream = stubUpstream.start(
+        latency=args.latency, jitter=args.jitter, errorRate=args.error_rate
+    )
+    transmission = stubTransmission.start()
+
+    # Never hand benchmark links to a real torrent client
+    getTV.system = "Linux"
+
+    webScrapeFetch.BASE = upstream.base()
+    webScrapeFetch.SHOWS_AT = webScrapeFetch.BASE + "/torrents.php?category=18;41"
+    webScrapeFetch.configure(requestsPerSecond=1000)
+
+    cwd = os.getcwd()
+    print(
+        "{:>8} {:>10} {:>10} {:>8} {:>9}".format(
+            "SHOWS", "first (s)", "repeat (s)", "added", "requests"
+        )
+    )
+
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            runner = controller(directory, syntheticShows(size))
+            runner.providerNames = args.providers
+            runner.providers = runner.establishProviders()
+            runner.torrentController.BASE = upstream.base() + "/pubapi_v2.php?"
+            runner.torrentController.limiter.configure(rate=1000)
+            runner.transmission = TransmissionClient(transmission.url())
+
+            upstream.requests = 0
+            added = len(transmission.added)
+
+            first = cycle(runner, args.verbose)
+            repeat = cycle(runner, args.verbose)
+
+            print(
+                "{:>8} {:>10.3f} {:>10.3f} {:>8} {:>9}".format(
+                    size,
+                    first,
+                    repeat,
+                    len(transmission.added) - added,
+                    upstream.requests,
+                )
+            )
+
+            runner.store.commit()
+            os.chdir(cwd)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+""" Compare webScrapeFetch HTML extraction backends on recorded pages.
+
+Usage: python3 benchmarks/benchParsers.py [-n ITERATIONS]
+"""
+
+import os
+import sys
+import timeit
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import webScrapeFetch  # noqa: E402
+
+
+def fixture(name):
+    with open(os.path.join(HERE, "fixtures", name), "r") as f:
+        return f.read()
+
+
+def bench(label, fn, arg, iterations):
+    seconds = timeit.timeit(lambda: fn(arg), number=iterations)
+    perCall = seconds / iterations * 1e3
+    print("{:<28} {:>10.3f} ms/page".format(label, perCall))
+    return perCall
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    indexPage = fixture("index.html")
+    episodePage = fixture("episode.html")
+
+    # Backends must agree before their timings mean anything
+    for name, (episodeLinks, magnetLink) in webScrapeFetch.EXTRACTORS.items():
+        assert episodeLinks(indexPage) == webScrapeFetch.episodeLinksSoup(
+            indexPage
+        ), name
+        assert magnetLink(episodePage) == webScrapeFetch.magnetLinkSoup(
+            episodePage
+        ), name
+
+    results = {}
+    for name, (episodeLinks, magnetLink) in webScrapeFetch.EXTRACTORS.items():
+        results[name] = (
+            bench(f"{name} index page", episodeLinks, indexPage, args.iterations),
+            bench(f"{name} episode page", magnetLink, episodePage, args.iterations),
+        )
+
+    soupIndex, soupEpisode = results["soup"]
+    fastIndex, fastEpisode = results["fast"]
+    print(
+        "fast speedup: {:.1f}x index, {:.1f}x episode".format(
+            soupIndex / fastIndex, soupEpisode / fastEpisode
+        )
+    )
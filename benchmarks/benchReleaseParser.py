@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+""" Benchmark release name parsing on a corpus of real release names.
+
+Compares releaseParser.parseRelease (cold and memoized) against the
+original multi-regex parser it replaced, after checking both agree.
+
+Usage: python3 benchmarks/benchReleaseParser.py [-n ITERATIONS]
+"""
+
+import os
+import re
+import sys
+import timeit
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import releaseParser  # noqa: E402
+
+
+def legacyParse(filename):
+    """ The original per-field parser, kept here as the baseline """
+    nameMatch = re.match(r"(.*?)\.(\d\d\d\d|S\d\d)", filename)
+    if not nameMatch:
+        return None
+
+    show = nameMatch.group(1).replace(".", " ")
+
+    episodeNumber = re.search(r"S\d\dE\d\d", filename)
+    episodeDate = re.search(r"\d\d\d\d\.\d\d\.\d\d", filename)
+    if episodeNumber:
+        episode = episodeNumber.group(0)
+    elif episodeDate:
+        episode = episodeDate.group(0)
+    else:
+        return None
+
+    quality = 480
+    qualityMatch = re.search(r"(720|1080|2160)", filename)
+    if qualityMatch:
+        quality = int(qualityMatch.group(1))
+
+    reencode = 0
+    for match in re.finditer(r"(REPACK|PROPER)", filename):
+        reencode += 1
+
+    uncensored = bool(re.search(r"UNCENSORED", filename, flags=re.IGNORECASE))
+    westLive = bool(re.search(r"WEST\.FEED", filename))
+
+    return (show.title(), episode, quality, reencode, uncensored, westLive)
+
+
+def corpus():
+    with open(os.path.join(HERE, "fixtures", "releases.txt"), "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    names = corpus()
+
+    for name in names:
+        assert releaseParser.parseRelease(name) == legacyParse(name), name
+
+    def runLegacy():
+        for name in names:
+            legacyParse(name)
+
+    def runCold():
+        releaseParser.parseRelease.cache_clear()
+        for name in names:
+            releaseParser.parseRelease(name)
+
+    def runWarm():
+        for name in names:
+            releaseParser.parseRelease(name)
+
+    total = len(names) * args.iterations
+    print("{} release names x {} iterations".format(len(names), args.iterations))
+    for label, fn in (("legacy", runLegacy), ("cold", runCold), ("memoized", runWarm)):
+        seconds = timeit.timeit(fn, number=args.iterations)
+        print("{:<10} {:>8.2f} us/name".format(label, seconds / total * 1e6))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+""" Microbenchmark the per-listing selection path on recorded release names:
+release parsing, SHOWS matching, and quality/duplicate qualification.
+
+Runs against a throwaway controller (temporary database and SHOWS file
+built from the shows in fixtures/releases.txt plus synthetic filler).
+HTML parser timings live in benchParsers.py.
+
+Usage: python3 benchmarks/benchSelection.py [-n ITERATIONS] [-s SHOWS]
+"""
+
+import os
+import sys
+import timeit
+import argparse
+import tempfile
+import contextlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import getTV  # noqa: E402
+import releaseParser  # noqa: E402
+
+
+def corpus():
+    with open(os.path.join(HERE, "fixtures", "releases.txt"), "r") as f:
+        return f.read().split()
+
+
+def syntheticShows(count):
+    """ 'count' SHOWS lines: every show in the corpus, then filler shows """
+    real = sorted(
+        {
+            release.show
+            for release in map(releaseParser.parseRelease, corpus())
+            if release
+        }
+    )
+    filler = ("Synthetic Show {:05d}".format(n) for n in range(count))
+    return (real + list(filler))[:count]
+
+
+def controller(directory, shows):
+    """ TVTorrentController with default settings working in 'directory' """
+    os.chdir(directory)
+    with open("SHOWS", "w") as f:
+        f.write("\n".join(shows) + "\n")
+
+    # Config file doesn't exist, so every setting is the in-code default
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        return getTV.TVTorrentController("bench.conf", mode="scrape")
+
+
+def bench(label, fn, names, iterations):
+    # Selection prints every skipped release; keep that out of the results
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        seconds = timeit.timeit(lambda: [fn(name) for name in names], number=iterations)
+
+    perName = seconds / (len(names) * iterations) * 1e6
+    print("{:<36} {:>8.2f} us/name".format(label, perName))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument("-s", "--shows", type=int, default=100)
+    args = parser.parse_args()
+
+    names = corpus()
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory:
+        runner = controller(directory, syntheticShows(args.shows))
+        shows = runner.loadShowList()
+
+        print(
+            "{} release names x {} iterations, {} SHOWS entries".format(
+                len(names), args.iterations, args.shows
+            )
+        )
+
+        def parseCold(name):
+            releaseParser.parseRelease.cache_clear()
+            return runner.showEpisodeQualityExtraFromFilename(name)
+
+        bench("showEpisodeQualityExtraFromFilename", parseCold, names, args.iterations)
+        bench(
+            "  (memoized)",
+            runner.showEpisodeQualityExtraFromFilename,
+            names,
+            args.iterations,
+        )
+        bench(
+            "showShouldBeSelected",
+            lambda name: runner.showShouldBeSelected(shows, name),
+            names,
+            args.iterations,
+        )
+        bench(
+            "qualifiesForSelection",
+            runner.qualifiesForSelection,
+            names,
+            args.iterations,
+        )
+
+        qualifies = [runner.qualifiesForSelection(name) for name in names]
+        print("{} of {} names qualify".format(sum(map(bool, qualifies)), len(names)))
+        runner.store.commit()
+        os.chdir(cwd)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+""" Time getTV.py the way cron runs it: a fresh interpreter per run,
+against the local stub upstream (stubUpstream.py) and stub transmission
+daemon (stubTransmission.py).
+
+Reports interpreter startup, 'import getTV', a full run (the upstream
+digest removed first, so every listing is matched against history) and
+an unchanged upstream run (which should stop after one request per
+provider), plus the slowest modules getTV imports.
+
+The database is preloaded with '--history' synthetic selections so
+loading download history costs what it would on a long-running install.
+
+Usage: python3 benchmarks/benchStartup.py [-n RUNS] [--history N]
+           [--shows N] [--providers scrape api]
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+import stubUpstream  # noqa: E402
+import stubTransmission  # noqa: E402
+from benchSelection import syntheticShows  # noqa: E402
+from downloadStore import DownloadStore  # noqa: E402
+from releaseParser import parseRelease  # noqa: E402
+
+# Runs getTV.py as __main__ with upstream URLs pointed at the stub
+BOOT = """
+import sys, runpy, platform
+sys.path.insert(0, {root!r})
+platform.system = lambda: "Linux"
+import torrentApi, webScrapeFetch
+torrentApi.REQUESTS_PER_SECOND = 1000
+init = torrentApi.TorrentApiController.__init__
+def stubbed(self, *args, **kwargs):
+    init(self, *args, **kwargs)
+    self.BASE = {base!r} + "/pubapi_v2.php?"
+torrentApi.TorrentApiController.__init__ = stubbed
+webScrapeFetch.BASE = {base!r}
+webScrapeFetch.SHOWS_AT = {base!r} + "/torrents.php?category=18;41"
+sys.argv = ["getTV.py", "-c", "tv.conf"]
+runpy.run_path({script!r}, run_name="__main__")
+"""
+
+CONFIG = """
+[remote]
+host = {transmission}
+
+[sources]
+providers = {providers}
+
+[files]
+db = downloads.db
+shows = SHOWS
+token = .torrentapi-token
+digest = .upstream-digest
+
+[scrape]
+requestsPerSecond = 1000
+"""
+
+
+def timed(command, upstream=None):
+    """ Wall time (and upstream requests) of running 'command' once """
+    if upstream:
+        upstream.requests = 0
+
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+
+    return elapsed, upstream.requests if upstream else 0
+
+
+def report(label, runs):
+    seconds = statistics.median(elapsed for elapsed, _ in runs)
+    requests = runs[-1][1]
+    print("{:<28} {:>9.1f} ms {:>9}".format(label, seconds * 1e3, requests))
+
+
+def preloadHistory(count):
+    store = DownloadStore("downloads.db")
+    for n in range(count):
+        # Release names can't tell shows apart by number, so use letters
+        name = "History.Show.{}.S{:02d}E{:02d}.720p.HDTV.x264-GRP".format(
+            chr(ord("A") + n // 9801), n // 99 % 99 + 1, n % 99 + 1
+        )
+        store.recordSelection(parseRelease(name))
+
+    store.commit()
+
+    # Close now: while we hold the database open, the runs we time never
+    # get to checkpoint it on exit like they would from cron
+    store.conn.close()
+
+
+def importBreakdown(top):
+    """ The 'top' slowest modules imported directly by getTV """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import getTV"],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+    # Modules are listed after everything they import; each nesting level
+    # indents the name by two more spaces
+    modules = []
+    children = []
+    for line in result.stderr.splitlines():
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+
+        if not name.startswith("  "):
+            if name.strip() == "getTV":
+                modules = children
+
+            children = []
+        elif not name.startswith("    "):
+            children.append((int(cumulative), name.strip()))
+
+    for microseconds, name in sorted(modules, reverse=True)[:top]:
+        print("  {:<26} {:>9.1f} ms".format(name, microseconds / 1e3))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--history", type=int, default=5000)
+    parser.add_argument("--shows", type=int, default=100)
+    parser.add_argument("--providers", nargs="+", default=["scrape"])
+    args = parser.parse_args()
+
+    upstream = stubUpstream.start()
+    transmission = stubTransmission.start()
+
+    boot = BOOT.format(
+        root=ROOT, base=upstream.base(), script=os.path.join(ROOT, "getTV.py")
+    )
+    getTV = [sys.executable, "-c", boot]
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        with open("tv.conf", "w") as f:
+            f.write(
+                CONFIG.format(
+                    transmission=transmission.url(),
+                    providers=" ".join(args.providers),
+                )
+            )
+
+        with open("SHOWS", "w") as f:
+            f.write("\n".join(syntheticShows(args.shows)) + "\n")
+
+        preloadHistory(args.history)
+
+        # First run downloads everything that matches; later runs find
+        # nothing new either way
+        timed(getTV, upstream)
+
+        print(
+            "{} runs each, {} SHOWS entries, {} selections in history".format(
+                args.runs, args.shows, args.history
+            )
+        )
+        print("{:<28} {:>12} {:>9}".format("", "median", "requests"))
+
+        interpreter = [timed([sys.executable, "-c", "pass"]) for _ in range(args.runs)]
+        report("interpreter", interpreter)
+
+        importGetTV = "import sys; sys.path.insert(0, {!r}); import getTV"
+        imports = [
+            timed([sys.executable, "-c", importGetTV.format(ROOT)])
+            for _ in range(args.runs)
+        ]
+        report("import getTV", imports)
+
+        full = []
+        for _ in range(args.runs):
+            if os.path.exists(".upstream-digest"):
+                os.remove(".upstream-digest")
+
+            full.append(timed(getTV, upstream))
+
+        report("full run", full)
+
+        unchanged = [timed(getTV, upstream) for _ in range(args.runs)]
+        report("unchanged upstream", unchanged)
+
+        os.chdir(cwd)
+
+    print("Slowest imports:")
+    importBreakdown(8)
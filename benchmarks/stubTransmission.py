@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+""" Minimal stand-in for transmission-daemon's RPC endpoint.
+
+Implements the X-Transmission-Session-Id 409 handshake, optional basic
+auth, and torrent-add (answering torrent-duplicate for repeated links).
+Useful for exercising transmissionRpc.TransmissionClient (and getTV with
+'[remote] host = 127.0.0.1:PORT') without a real daemon.
+
+Usage: python3 benchmarks/stubTransmission.py [-p PORT] [--fail-rate RATE]
+"""
+
+import json
+import base64
+import random
+import argparse
+import threading
+import http.server
+
+SESSION_HEADER = "X-Transmission-Session-Id"
+
+
+class StubTransmission(http.server.ThreadingHTTPServer):
+    def __init__(self, address, username=None, password=None, failRate=0.0):
+        super().__init__(address, StubTransmissionHandler)
+        self.sessionId = "stub-session-{:x}".format(random.getrandbits(64))
+        self.credentials = None
+        if username:
+            self.credentials = base64.b64encode(
+                "{}:{}".format(username, password or "").encode()
+            ).decode()
+
+        self.failRate = failRate
+        self.added = []
+        self.lock = threading.Lock()
+
+    def url(self):
+        return "http://{}:{}/transmission/rpc".format(*self.server_address)
+
+
+class StubTransmissionHandler(http.server.BaseHTTPRequestHandler):
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        payload = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if server.credentials:
+            if self.headers.get("Authorization") != "Basic " + server.credentials:
+                return self.reply(401)
+
+        if self.headers.get(SESSION_HEADER) != server.sessionId:
+            return self.reply(409, headers={SESSION_HEADER: server.sessionId})
+
+        request = json.loads(payload)
+        if request.get("method") != "torrent-add":
+            result = {"result": "method name not recognized", "arguments": {}}
+        elif random.random() < server.failRate:
+            result = {"result": "simulated failure", "arguments": {}}
+        else:
+            link = request["arguments"]["filename"]
+            with server.lock:
+                key = "torrent-duplicate" if link in server.added else "torrent-added"
+                server.added.append(link)
+
+            torrent = {"id": len(server.added), "name": link[:40]}
+            result = {"result": "success", "arguments": {key: torrent}}
+
+        self.reply(200, json.dumps(result).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def start(port=0, **kwargs):
+    """ Run a StubTransmission in a background thread and return it """
+    server = StubTransmission(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=9091)
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StubTransmission(
+        ("127.0.0.1", args.port),
+        username=args.username,
+        password=args.password,
+        failRate=args.fail_rate,
+    )
+    print("Stub transmission RPC listening on", server.url())
+    server.serve_forever()
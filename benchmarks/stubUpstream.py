@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+""" Local stand-in for the scraped site and torrentapi.org.
+
+Replays the recorded fixtures: index pages are the recorded index.html
+layout filled with 25 names per page from fixtures/releases.txt, episode
+pages are the recorded episode.html with a per-release magnet link, and
+the API serves fixtures/api.json. Every response can be delayed
+('latency' seconds plus up to 'jitter' more) and a fraction of them
+('errorRate') answered with 503 instead.
+
+Point getTV at it with webScrapeFetch.BASE/SHOWS_AT and
+TorrentApiController.BASE (see benchCycle.py).
+
+Usage: python3 benchmarks/stubUpstream.py [-p PORT] [--latency S] [--error-rate R]
+"""
+
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import http.server
+import urllib.parse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PER_PAGE = 25
+
+SHOWS_PATH = "/torrents.php"
+API_PATH = "/pubapi_v2.php"
+
+RECORDED_ROW = re.compile(r'<tr class="lista2">.*?</tr>\n?', re.DOTALL)
+RECORDED_MAGNET = re.compile(r'magnet:\?xt=urn:btih:[0-9a-f]{40}&amp;dn=[^&"]*')
+
+
+def fixture(name):
+    with open(os.path.join(HERE, "fixtures", name), "r") as f:
+        return f.read()
+
+
+def releaseId(name):
+    return hashlib.sha1(name.encode()).hexdigest()
+
+
+class StubUpstream(http.server.ThreadingHTTPServer):
+    def __init__(self, address, latency=0.0, jitter=0.0, errorRate=0.0):
+        super().__init__(address, StubUpstreamHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        self.releases = fixture("releases.txt").split()
+        self.byId = {releaseId(name)[:7]: name for name in self.releases}
+        self.api = fixture("api.json").encode()
+        self.episode = fixture("episode.html")
+
+        # Split the recorded index page around its listing rows so we can
+        # render any page of releases with the same surrounding markup.
+        index = fixture("index.html")
+        rows = list(RECORDED_ROW.finditer(index))
+        self.indexHead = index[: rows[0].start()]
+        self.indexTail = index[rows[-1].end() :]
+
+        recorded = rows[0].group(0)
+        name = re.search(r'title="([^"]*)"', recorded).group(1)
+        href = re.search(r'href="(/torrent/[^"]*)"', recorded).group(1)
+        self.indexRow = recorded.replace(name, "{name}").replace(href, "{href}")
+
+    def base(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def indexPage(self, page):
+        names = self.releases[(page - 1) * PER_PAGE : page * PER_PAGE]
+        rows = [
+            self.indexRow.format(name=name, href="/torrent/" + releaseId(name)[:7])
+            for name in names
+        ]
+        return self.indexHead + "".join(rows) + self.indexTail
+
+    def episodePage(self, name):
+        magnet = "magnet:?xt=urn:btih:{}&amp;dn={}".format(
+            releaseId(name), urllib.parse.quote(name)
+        )
+        return RECORDED_MAGNET.sub(magnet, self.episode)
+
+
+class StubUpstreamHandler(http.server.BaseHTTPRequestHandler):
+    def reply(self, status, body=b"", contentType="text/html", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        if random.random() < server.errorRate:
+            return self.reply(503, b"busy", headers={"Retry-After": "0"})
+
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == API_PATH:
+            if "get_token" in query:
+                body = json.dumps({"token": "stub-token"}).encode()
+            else:
+                body = server.api
+
+            return self.reply(200, body, "application/json")
+
+        if url.path == SHOWS_PATH:
+            page = int(query.get("page", ["1"])[0])
+            return self.reply(200, server.indexPage(page).encode())
+
+        if url.path.startswith("/torrent/"):
+            name = server.byId.get(url.path[len("/torrent/") :])
+            if name:
+                return self.reply(200, server.episodePage(name).encode())
+
+        self.reply(404)
+
+    def log_message(self, *args):
+        pass
+
+
+def start(port=0, latency=0.0, jitter=0.0, errorRate=0.0):
+    """ Run a StubUpstream in the background; port 0 picks a free port """
+    server = StubUpstream(("127.0.0.1", port), latency, jitter, errorRate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StubUpstream(
+        ("127.0.0.1", args.port), args.latency, args.jitter, args.error_rate
+    )
+    print("Stub upstream at", server.base())
+    server.serve_forever()
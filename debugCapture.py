@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import atexit
+import time
+import queue
+import threading
+import collections
+
+# What to capture:
+#   - "off" captures nothing (default)
+#   - "errors" captures error responses and captcha/empty listing pages
+#   - "all" captures every response
+MODES = ("off", "errors", "all")
+
+
+class CaptureRing:
+    """ Keeps the most recent upstream responses on disk for debugging.
+
+    Captures are handed to a background writer thread so requests never
+    wait on disk. The ring is bounded by entry count and total bytes; the
+    oldest captures are deleted first. Captures are dropped (not queued)
+    if the writer falls too far behind.
+    """
+
+    def __init__(
+        self,
+        directory="debug",
+        mode="off",
+        maxEntries=50,
+        maxBytes=20 << 20,
+        compress=True,
+    ):
+        self.directory = directory
+        self.mode = mode
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.compress = compress
+        self.pending = queue.Queue(maxsize=100)
+        self.ring = None  # deque of (path, size), oldest first
+        self.sequence = 0
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def configure(
+        self, mode=None, directory=None, maxEntries=None, maxBytes=None, compress=None
+    ):
+        if mode:
+            if mode not in MODES:
+                raise ValueError("Unknown capture mode: {}".format(mode))
+
+            self.mode = mode
+
+        if directory:
+            self.directory = directory
+        if maxEntries:
+            self.maxEntries = maxEntries
+        if maxBytes:
+            self.maxBytes = maxBytes
+        if compress is not None:
+            self.compress = compress
+
+    def capture(self, url, status, body, reason=None):
+        """ Remember one response. 'reason' marks it as an error capture. """
+        if self.mode == "off" or (self.mode == "errors" and not reason):
+            return
+
+        with self.lock:
+            if not self.writer:
+                self.writer = threading.Thread(target=self.write, daemon=True)
+                self.writer.start()
+
+                # Captcha pages often come right before we exit
+                atexit.register(self.flush)
+
+        try:
+            self.pending.put_nowait((time.time(), url, status, body, reason))
+        except queue.Full:
+            pass
+
+    def load(self):
+        """ Pick up captures left by previous runs so they count too """
+        os.makedirs(self.directory, exist_ok=True)
+
+        ring = collections.deque()
+        for name in sorted(os.listdir(self.directory)):
+            if name[:8].isdigit() and name.endswith((".html", ".html.gz")):
+                path = os.path.join(self.directory, name)
+                ring.append((path, os.path.getsize(path)))
+
+        if ring:
+            last = os.path.basename(ring[-1][0])
+            self.sequence = int(last.split("-")[0]) + 1
+
+        self.ring = ring
+
+    def write(self):
+        while True:
+            capturedAt, url, status, body, reason = self.pending.get()
+
+            try:
+                if self.ring is None:
+                    self.load()
+
+                self.store(capturedAt, url, status, body, reason)
+            except OSError as e:
+                print("Couldn't write debug capture:", e)
+            finally:
+                self.pending.task_done()
+
+    def flush(self):
+        """ Wait for queued captures to reach the disk """
+        self.pending.join()
+
+    def store(self, capturedAt, url, status, body, reason):
+        name = "{:08d}-{}-{}.html".format(
+            self.sequence,
+            time.strftime("%Y%m%d%H%M%S", time.localtime(capturedAt)),
+            status,
+        )
+        self.sequence += 1
+
+        # Keep where it came from with the body
+        header = "<!-- {} {} {} -->\n".format(url, status, reason or "")
+        data = (header + body).encode("utf-8", "replace")
+
+        path = os.path.join(self.directory, name)
+        if self.compress:
+            path += ".gz"
+            data = gzip.compress(data)
+
+        with open(path, "wb") as f:
+            f.write(data)
+
+        self.ring.append((path, len(data)))
+
+        total = sum(size for _, size in self.ring)
+        while len(self.ring) > 1 and (
+            len(self.ring) > self.maxEntries or total > self.maxBytes
+        ):
+            oldest, size = self.ring.popleft()
+            total -= size
+            try:
+                os.remove(oldest)
+            except FileNotFoundError:
+                pass
+
+
+# Shared by every fetcher (configured from [debug] in tv.conf)
+ring = CaptureRing()
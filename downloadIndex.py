@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+
+class DownloadIndex:
+    """ In-memory copy of previous selections for duplicate checks.
+
+    Keyed by (show, episode, uncensored, westLive). For each key we keep
+    only the (quality, reencode) pairs not already covered by another pair
+    with both quality and reencode at least as high, so lookups only
+    compare against a handful of entries.
+
+    Loaded once from the database then kept current by add(), so
+    checking a candidate never touches the database.
+    """
+
+    def __init__(self):
+        self.selected = {}
+
+    def __len__(self):
+        return sum(len(frontier) for frontier in self.selected.values())
+
+    @staticmethod
+    def key(show, episode, uncensored, westLive):
+        return (show, episode, bool(uncensored), bool(westLive))
+
+    def add(self, details):
+        (show, episode, quality, reencode, uncensored, westLive) = details
+
+        key = self.key(show, episode, uncensored, westLive)
+        frontier = self.selected.setdefault(key, [])
+
+        for q, r in frontier:
+            if q >= quality and r >= reencode:
+                # Already covered by an existing selection
+                return
+
+        frontier[:] = [(q, r) for q, r in frontier if q > quality or r > reencode]
+        frontier.append((quality, reencode))
+
+    def alreadySelected(self, details):
+        """ True if 'details' (or better) was selected before.
+
+        Same rule as the original SQL query: an existing selection of the
+        same show+ep+variant with quality >= and reencode >= this one.
+        """
+        (show, episode, quality, reencode, uncensored, westLive) = details
+
+        key = self.key(show, episode, uncensored, westLive)
+        for q, r in self.selected.get(key, ()):
+            if q >= quality and r >= reencode:
+                return True
+
+        return False
+
+    @classmethod
+    def fromSelections(cls, selections):
+        index = cls()
+        for details in selections:
+            index.add(details)
+
+        return index
+
+    def verify(self, selections):
+        """ Compare against 'selections' (e.g. everything in the database);
+        return list of differing keys """
+        expected = DownloadIndex.fromSelections(selections)
+
+        differ = []
+        for key in set(self.selected) | set(expected.selected):
+            mine = sorted(self.selected.get(key, []))
+            theirs = sorted(expected.selected.get(key, []))
+            if mine != theirs:
+                differ.append((key, mine, theirs))
+
+        return differ
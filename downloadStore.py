@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+
+import time
+import sqlite3
+import threading
+
+from releaseParser import Release
+
+
+def encodeEpisode(episode):
+    """ Pack an episode identifier into one integer.
+
+    S07E02 -> 702 (season * 100 + episode)
+    2016.09.01 -> 20160901 (always >= 10,000,000 so it can't collide)
+    """
+    if episode[0] == "S":
+        return int(episode[1:3]) * 100 + int(episode[4:6])
+
+    return int(episode.replace(".", ""))
+
+
+def decodeEpisode(encoded):
+    if encoded >= 10000000:
+        return "{}.{:02d}.{:02d}".format(
+            encoded // 10000, encoded // 100 % 100, encoded % 100
+        )
+
+    return "S{:02d}E{:02d}".format(encoded // 100, encoded % 100)
+
+
+def releaseFromRow(row):
+    """ Release for a (name, episode, quality, reencode, uncensored,
+    westlive) row as stored """
+    (show, episode, quality, reencode, uncensored, westlive) = row
+    return Release(
+        show,
+        decodeEpisode(episode),
+        quality,
+        reencode,
+        bool(uncensored),
+        bool(westlive),
+    )
+
+
+def migrateLegacySchema(conn):
+    """ Version 1: the original schema (a no-op for databases created by
+    older versions of getTV, which already have these tables). """
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS episodes
+                      (show, episode, quality, reencode,
+                       uncensored, westlive,
+                       UNIQUE (show, episode, quality, reencode,
+                               uncensored, westlive)
+                       ON CONFLICT ABORT)"""
+    )
+
+    # The UNIQUE constraint already has an index over the same columns
+    conn.execute("DROP INDEX IF EXISTS epidx")
+
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS highwater
+                      (source TEXT PRIMARY KEY, lastSeen TEXT)"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS magnets
+                      (url TEXT PRIMARY KEY, magnet TEXT, fetchedAt REAL)"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS magnetsAge ON magnets (fetchedAt)")
+
+
+def migrateNormalizedSchema(conn):
+    """ Version 2: intern show names and store episodes as integers.
+
+    Every previous selection is copied over, then the old table is dropped.
+    """
+    conn.execute(
+        """CREATE TABLE shows
+                      (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)"""
+    )
+    conn.execute(
+        """CREATE TABLE selections
+                      (showId INTEGER NOT NULL REFERENCES shows (id),
+                       episode INTEGER NOT NULL,
+                       uncensored INTEGER NOT NULL,
+                       westlive INTEGER NOT NULL,
+                       quality INTEGER NOT NULL,
+                       reencode INTEGER NOT NULL,
+                       PRIMARY KEY (showId, episode, uncensored, westlive,
+                                    quality, reencode))
+                      WITHOUT ROWID"""
+    )
+
+    rows = conn.execute(
+        """SELECT show, episode, quality, reencode, uncensored, westlive
+               FROM episodes"""
+    ).fetchall()
+
+    shows = {}
+    for show, episode, quality, reencode, uncensored, westlive in rows:
+        if show not in shows:
+            shows[show] = conn.execute(
+                "INSERT INTO shows (name) VALUES (?)", (show,)
+            ).lastrowid
+
+        conn.execute(
+            "INSERT OR IGNORE INTO selections VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                shows[show],
+                encodeEpisode(episode),
+                int(bool(uncensored)),
+                int(bool(westlive)),
+                quality,
+                reencode,
+            ),
+        )
+
+    conn.execute("DROP TABLE episodes")
+
+
+def migrateShowActivity(conn):
+    """ Version 3: remember when each show last had a release selected """
+    conn.execute("ALTER TABLE shows ADD COLUMN lastActiveAt REAL")
+
+
+def migrateHolds(conn):
+    """ Version 4: releases held back until 'deadline' in case a better
+    release of the same episode shows up (one row per episode variant) """
+    conn.execute(
+        """CREATE TABLE holds
+                      (showId INTEGER NOT NULL REFERENCES shows (id),
+                       episode INTEGER NOT NULL,
+                       uncensored INTEGER NOT NULL,
+                       westlive INTEGER NOT NULL,
+                       quality INTEGER NOT NULL,
+                       reencode INTEGER NOT NULL,
+                       magnet TEXT NOT NULL,
+                       filename TEXT NOT NULL,
+                       deadline REAL NOT NULL,
+                       PRIMARY KEY (showId, episode, uncensored, westlive))
+                      WITHOUT ROWID"""
+    )
+    conn.execute("CREATE INDEX holdsDeadline ON holds (deadline)")
+
+
+def migrateOutbox(conn):
+    """ Version 5: selected releases whose magnet links haven't reached the
+    torrent client yet, each retried at 'nextAttemptAt' until one does """
+    conn.execute(
+        """CREATE TABLE outbox
+                      (showId INTEGER NOT NULL REFERENCES shows (id),
+                       episode INTEGER NOT NULL,
+                       uncensored INTEGER NOT NULL,
+                       westlive INTEGER NOT NULL,
+                       quality INTEGER NOT NULL,
+                       reencode INTEGER NOT NULL,
+                       magnet TEXT NOT NULL,
+                       filename TEXT NOT NULL,
+                       queuedAt REAL NOT NULL,
+                       attempts INTEGER NOT NULL DEFAULT 0,
+                       nextAttemptAt REAL NOT NULL,
+                       PRIMARY KEY (showId, episode, uncensored, westlive,
+                                    quality, reencode))
+                      WITHOUT ROWID"""
+    )
+    conn.execute("CREATE INDEX outboxNextAttempt ON outbox (nextAttemptAt)")
+
+
+def migrateShowSearches(conn):
+    """ Version 6: remember when each show was last searched for """
+    conn.execute("ALTER TABLE shows ADD COLUMN lastSearchedAt REAL")
+
+
+class DownloadStore:
+    """ Everything getTV keeps in its sqlite database.
+
+    The schema version lives in PRAGMA user_version; on open, every
+    migration in MIGRATIONS newer than the stored version runs in order
+    (each inside its own transaction).
+
+    Writes are not committed individually. Callers group a whole cycle of
+    writes and call commit() once, which matters a lot on slow storage.
+    """
+
+    MIGRATIONS = [
+        migrateLegacySchema,
+        migrateNormalizedSchema,
+        migrateShowActivity,
+        migrateHolds,
+        migrateOutbox,
+        migrateShowSearches,
+    ]
+
+    def __init__(self, filename):
+        # Autocommit mode so we control transactions explicitly.
+        # The connection is shared by the selection and dispatch threads
+        # in daemon mode, so every use goes through self.lock.
+        self.conn = sqlite3.connect(
+            filename, isolation_level=None, check_same_thread=False
+        )
+        self.lock = threading.RLock()
+
+        # WAL lets readers proceed during writes and needs far fewer
+        # fsyncs per commit; NORMAL sync is still durable at checkpoints.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        self.migrate()
+        self.showIds = dict(
+            (name, showId)
+            for showId, name in self.conn.execute("SELECT id, name FROM shows")
+        )
+
+        self.inTransaction = False
+
+    def version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        current = self.version()
+        for version, migration in enumerate(self.MIGRATIONS, start=1):
+            if version <= current:
+                continue
+
+            print("Migrating database to schema version", version)
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                migration(self.conn)
+                self.conn.execute("PRAGMA user_version = {:d}".format(version))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def begin(self):
+        with self.lock:
+            if not self.inTransaction:
+                self.conn.execute("BEGIN")
+                self.inTransaction = True
+
+    def commit(self):
+        with self.lock:
+            if self.inTransaction:
+                self.conn.execute("COMMIT")
+                self.inTransaction = False
+
+    def execute(self, sql, parameters=()):
+        """ Run a write inside the current (possibly implicit) transaction """
+        with self.lock:
+            self.begin()
+            return self.conn.execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        with self.lock:
+            self.begin()
+            return self.conn.executemany(sql, parameters)
+
+    def query(self, sql, parameters=()):
+        """ Return all rows for a read-only query """
+        with self.lock:
+            return self.conn.execute(sql, parameters).fetchall()
+
+    def showId(self, show):
+        with self.lock:
+            if show not in self.showIds:
+                self.showIds[show] = self.execute(
+                    "INSERT INTO shows (name) VALUES (?)", (show,)
+                ).lastrowid
+
+            return self.showIds[show]
+
+    def recordSelection(self, details):
+        (show, episode, quality, reencode, uncensored, westLive) = details
+        with self.lock:
+            self.execute(
+                "INSERT INTO selections VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self.showId(show),
+                    encodeEpisode(episode),
+                    int(bool(uncensored)),
+                    int(bool(westLive)),
+                    quality,
+                    reencode,
+                ),
+            )
+            self.execute(
+                "UPDATE shows SET lastActiveAt=? WHERE id=?",
+                (time.time(), self.showId(show)),
+            )
+
+            # Nothing held back for this episode is worth downloading now
+            self.execute(
+                """DELETE FROM holds
+                       WHERE showId=? AND episode=? AND uncensored=?
+                         AND westlive=? AND quality<=? AND reencode<=?""",
+                self.holdKey(details) + (quality, reencode),
+            )
+
+    def holdKey(self, details):
+        (show, episode, _, _, uncensored, westLive) = details
+        return (
+            self.showId(show),
+            encodeEpisode(episode),
+            int(bool(uncensored)),
+            int(bool(westLive)),
+        )
+
+    def hold(self, details, magnet, filename, deadline):
+        """ Hold a release back until 'deadline' unless an equal or better
+        release (by quality, then reencode) of the same episode is held
+        already. A better release takes over the existing deadline.
+
+        Returns True if this release is now the one held.
+        """
+        (_, _, quality, reencode, _, _) = details
+
+        with self.lock:
+            key = self.holdKey(details)
+            rows = self.query(
+                """SELECT quality, reencode, deadline FROM holds
+                       WHERE showId=? AND episode=? AND uncensored=?
+                         AND westlive=?""",
+                key,
+            )
+
+            if rows:
+                heldQuality, heldReencode, heldDeadline = rows[0]
+                if (heldQuality, heldReencode) >= (quality, reencode):
+                    return False
+
+                deadline = heldDeadline
+
+            self.execute(
+                "INSERT OR REPLACE INTO holds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                key + (quality, reencode, magnet, filename, deadline),
+            )
+            return True
+
+    def dueHolds(self, now):
+        """ [(Release, magnet, filename)] for holds with deadlines by 'now' """
+        due = []
+        for row in self.query(
+            """SELECT name, episode, quality, reencode, uncensored, westlive,
+                      magnet, filename
+                   FROM holds JOIN shows ON shows.id = showId
+                   WHERE deadline <= ? ORDER BY deadline""",
+            (now,),
+        ):
+            due.append((releaseFromRow(row[:6]), row[6], row[7]))
+
+        return due
+
+    def dropHold(self, details):
+        self.execute(
+            """DELETE FROM holds
+                   WHERE showId=? AND episode=? AND uncensored=? AND westlive=?""",
+            self.holdKey(details),
+        )
+
+    def nextHoldDeadline(self, after=None):
+        """ Earliest deadline (later than 'after', if given) of anything
+        held back, or None """
+        if after is None:
+            return self.query("SELECT MIN(deadline) FROM holds")[0][0]
+
+        return self.query(
+            "SELECT MIN(deadline) FROM holds WHERE deadline > ?", (after,)
+        )[0][0]
+
+    def enqueue(self, details, magnet, filename):
+        """ Record 'details' as selected and queue its magnet link for the
+        torrent client, both in the current transaction. A queued release
+        this one makes pointless (same episode, no better) is dropped. """
+        (_, _, quality, reencode, _, _) = details
+
+        with self.lock:
+            self.recordSelection(details)
+
+            key = self.holdKey(details)
+            self.execute(
+                """DELETE FROM outbox
+                       WHERE showId=? AND episode=? AND uncensored=?
+                         AND westlive=? AND quality<=? AND reencode<=?""",
+                key + (quality, reencode),
+            )
+
+            now = time.time()
+            self.execute(
+                """INSERT INTO outbox
+                       (showId, episode, uncensored, westlive, quality,
+                        reencode, magnet, filename, queuedAt, nextAttemptAt)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                key + (quality, reencode, magnet, filename, now, now),
+            )
+
+    def dueDeliveries(self, now):
+        """ [(Release, magnet, filename, attempts)] queued for delivery by
+        'now', oldest first """
+        return [
+            (releaseFromRow(row[:6]), row[6], row[7], row[8])
+            for row in self.query(
+                """SELECT name, episode, quality, reencode, uncensored,
+                          westlive, magnet, filename, attempts
+                       FROM outbox JOIN shows ON shows.id = showId
+                       WHERE nextAttemptAt <= ? ORDER BY queuedAt""",
+                (now,),
+            )
+        ]
+
+    def delivered(self, details):
+        """ Remove 'details' from the outbox once the client accepted it """
+        (_, _, quality, reencode, _, _) = details
+        self.execute(
+            """DELETE FROM outbox
+                   WHERE showId=? AND episode=? AND uncensored=? AND westlive=?
+                     AND quality=? AND reencode=?""",
+            self.holdKey(details) + (quality, reencode),
+        )
+
+    def deferDelivery(self, details, retryAt):
+        """ Count a failed delivery of 'details' and retry it at 'retryAt' """
+        (_, _, quality, reencode, _, _) = details
+        self.execute(
+            """UPDATE outbox SET attempts=attempts + 1, nextAttemptAt=?
+                   WHERE showId=? AND episode=? AND uncensored=? AND westlive=?
+                     AND quality=? AND reencode=?""",
+            (retryAt,) + self.holdKey(details) + (quality, reencode),
+        )
+
+    def nextDeliveryAttempt(self):
+        """ When the next queued magnet link is due for delivery, or None """
+        return self.query("SELECT MIN(nextAttemptAt) FROM outbox")[0][0]
+
+    def selections(self):
+        """ Yield every previous selection as a Release """
+        for row in self.query(
+            """SELECT name, episode, quality, reencode, uncensored, westlive
+                   FROM selections JOIN shows ON shows.id = showId"""
+        ):
+            yield releaseFromRow(row)
+
+    def showActivity(self):
+        """ Map of lowercased show name to when it last had a selection """
+        return dict(
+            (name.lower(), lastActiveAt)
+            for name, lastActiveAt in self.query(
+                "SELECT name, lastActiveAt FROM shows WHERE lastActiveAt IS NOT NULL"
+            )
+        )
+
+    def showSearches(self):
+        """ Map of lowercased show name to when it was last searched for """
+        return dict(
+            (name.lower(), lastSearchedAt)
+            for name, lastSearchedAt in self.query(
+                "SELECT name, lastSearchedAt FROM shows "
+                "WHERE lastSearchedAt IS NOT NULL"
+            )
+        )
+
+    def recordSearch(self, show):
+        """ Remember that 'show' (a SHOWS name) was just searched for """
+        # Same normalization parseRelease() applies, so searches and
+        # selections of one show share a row
+        self.execute(
+            "UPDATE shows SET lastSearchedAt=? WHERE id=?",
+            (time.time(), self.showId(show.title())),
+        )
+
+    def lastSeen(self, source):
+        """ Newest listing entry seen by the previous run for 'source' """
+        rows = self.query("SELECT lastSeen FROM highwater WHERE source=?", (source,))
+
+        return rows[0][0] if rows else None
+
+    def recordLastSeen(self, source, lastSeen):
+        self.execute(
+            "INSERT OR REPLACE INTO highwater VALUES (?, ?)", (source, lastSeen)
+        )
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import re
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Pages served instead of content when we're being throttled or challenged
+# (cloudflare challenges, rarbg's threat defence page)
+CAPTCHA = re.compile(rb"captcha|cf-chl|challenge-form|threat_defence", re.IGNORECASE)
+
+# Health penalties; an egress is quarantined once its score reaches
+# QUARANTINE_SCORE. Every good response halves the score.
+PENALTY = {"error": 1, "throttled": 1, "captcha": 3}
+QUARANTINE_SCORE = 3
+
+# Weight of the newest response in an egress's average latency
+LATENCY_WEIGHT = 0.3
+
+quarantines = metrics.registry.counter(
+    "gettv_egress_quarantines_total", "Times each egress was quarantined"
+)
+latencies = metrics.registry.gauge(
+    "gettv_egress_latency_seconds", "Average response time of each egress"
+)
+scores = metrics.registry.gauge(
+    "gettv_egress_health_score",
+    "Penalty score of each egress (quarantined once it reaches {})".format(
+        QUARANTINE_SCORE
+    ),
+)
+quarantinedUntil = metrics.registry.gauge(
+    "gettv_egress_quarantined_until_seconds",
+    "Unix time each egress's latest quarantine ends",
+)
+
+
+class Egress:
+    """ One way out to the internet: a local source IP and/or a proxy.
+
+    Every egress has its own keep-alive session (so connections are never
+    shared between source IPs or proxies) and its own health record.
+    """
+
+    def __init__(self, sourceIP=None, proxy=None, poolSize=10):
+        self.sourceIP = sourceIP
+        self.proxy = proxy
+        self.name = "{}{}".format(
+            sourceIP or "default", " via " + proxy if proxy else ""
+        )
+
+        self.session = requests.Session()
+        if sourceIP:
+            # requests_toolbelt is only loaded when binding a source IP
+            from requests_toolbelt.adapters.source import SourceAddressAdapter
+
+            adapter = SourceAddressAdapter(
+                sourceIP, pool_connections=4, pool_maxsize=poolSize
+            )
+        else:
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=poolSize)
+
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.proxies = {"https": proxy, "http": proxy} if proxy else {}
+
+        self.latency = None
+        self.score = 0.0
+        self.inFlight = 0
+        self.quarantinedUntil = 0
+        self.quarantines = 0
+
+    def __repr__(self):
+        return "Egress({})".format(self.name)
+
+
+class EgressPool:
+    """ Spreads requests across every configured egress.
+
+    Each request goes out through the healthy egress with the fewest
+    requests in flight (then the lowest average latency). Errors, 429s and
+    captcha pages count against an egress; once it looks blocked it's
+    quarantined for 'quarantineSeconds' (doubling each time it happens
+    again, up to a day) while the rest carry the load. If everything is
+    quarantined we still use whichever comes back first rather than stall.
+
+    Conforms to the part of the 'requests' API we use (get()), so it can
+    stand in for a Session.
+    """
+
+    def __init__(self, egresses, quarantineSeconds=600):
+        self.egresses = egresses
+        self.quarantineSeconds = quarantineSeconds
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fromAddresses(cls, sourceIPs=(), proxies=(), quarantineSeconds=600):
+        """ One egress per (source IP, proxy) combination """
+        egresses = [
+            Egress(sourceIP, proxy)
+            for sourceIP in (sourceIPs or [None])
+            for proxy in (proxies or [None])
+        ]
+        return cls(egresses, quarantineSeconds)
+
+    def choose(self):
+        with self.lock:
+            now = time.monotonic()
+            healthy = [e for e in self.egresses if e.quarantinedUntil <= now]
+            if not healthy:
+                egress = min(self.egresses, key=lambda e: e.quarantinedUntil)
+            else:
+                # Random tie break so idle, unmeasured egresses share load
+                egress = min(
+                    healthy,
+                    key=lambda e: (e.inFlight, e.latency or 0, random.random()),
+                )
+
+            egress.inFlight += 1
+            return egress
+
+    def record(self, egress, elapsed, outcome=None):
+        with self.lock:
+            egress.inFlight -= 1
+
+            if outcome == "error":
+                # Failed connections say nothing useful about latency
+                pass
+            elif egress.latency is None:
+                egress.latency = elapsed
+            else:
+                egress.latency += LATENCY_WEIGHT * (elapsed - egress.latency)
+
+            duration = None
+            if not outcome:
+                egress.score /= 2
+            else:
+                egress.score += PENALTY[outcome]
+
+            if egress.score >= QUARANTINE_SCORE:
+                duration = min(
+                    86400, self.quarantineSeconds * 2 ** egress.quarantines
+                )
+                egress.quarantinedUntil = time.monotonic() + duration
+                egress.quarantines += 1
+                egress.score = 0.0
+
+            if egress.latency is not None:
+                latencies.set(egress.latency, egress=egress.name)
+            scores.set(egress.score, egress=egress.name)
+
+        if not duration:
+            return
+
+        quarantines.inc(egress=egress.name)
+        quarantinedUntil.set(time.time() + duration, egress=egress.name)
+        print(
+            "Quarantining egress {} for {:.0f} seconds ({})".format(
+                egress.name, duration, outcome
+            )
+        )
+
+    def get(self, url, proxies=None, **kwargs):
+        egress = self.choose()
+        start = time.monotonic()
+        try:
+            r = egress.session.get(url, proxies=egress.proxies or proxies, **kwargs)
+        except requests.RequestException:
+            self.record(egress, time.monotonic() - start, "error")
+            raise
+
+        outcome = None
+        if r.status_code == requests.codes.too_many_requests:
+            outcome = "throttled"
+        elif r.status_code in (200, 403, 503) and CAPTCHA.search(r.content[:65536]):
+            outcome = "captcha"
+        elif r.status_code >= 500:
+            outcome = "error"
+
+        self.record(egress, time.monotonic() - start, outcome)
+        return r
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import contextlib
+
+# How often lease waiters check whether the fetcher finished
+POLL_SECONDS = 0.5
+
+
+class SharedFetchCache:
+    """ Upstream results shared by every getTV instance on this machine.
+
+    Many instances (each with their own tv.conf and SHOWS) can point at the
+    same cache file. For each source, one instance at a time holds a lease
+    and fetches; everybody else waits for it and reuses the stored result
+    until it's 'maxAge' seconds old. Upstream load stays the same no matter
+    how many instances we run.
+
+    A lease expires after 'leaseSeconds' so a crashed fetcher can't block
+    the others forever.
+    """
+
+    def __init__(self, filename, maxAge=60, leaseSeconds=300):
+        self.filename = filename
+        self.maxAge = maxAge
+        self.leaseSeconds = leaseSeconds
+        self.holder = "{}:{}:{:x}".format(socket.gethostname(), os.getpid(), id(self))
+
+        with contextlib.closing(self.connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS fetches "
+                "(source TEXT PRIMARY KEY, fetchedAt REAL, result TEXT)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(source TEXT PRIMARY KEY, holder TEXT, expiresAt REAL)"
+            )
+
+    def connect(self):
+        # Connections are cheap and this is used from provider threads and
+        # other processes, so each operation gets its own.
+        db = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+        db.execute("PRAGMA busy_timeout=30000")
+        return db
+
+    def read(self, source):
+        """ Return (fetchedAt, result) for 'source' or (None, None) """
+        with contextlib.closing(self.connect()) as db:
+            row = db.execute(
+                "SELECT fetchedAt, result FROM fetches WHERE source=?", (source,)
+            ).fetchone()
+
+        if not row:
+            return None, None
+
+        return row[0], json.loads(row[1])
+
+    def acquire(self, source):
+        """ Take the fetch lease for 'source' if nobody else holds it """
+        db = self.connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT holder, expiresAt FROM leases WHERE source=?", (source,)
+            ).fetchone()
+
+            now = time.time()
+            if row and row[0] != self.holder and row[1] > now:
+                db.execute("ROLLBACK")
+                return False
+
+            db.execute(
+                "INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                (source, self.holder, now + self.leaseSeconds),
+            )
+            db.execute("COMMIT")
+            return True
+        finally:
+            db.close()
+
+    def release(self, source, result=None):
+        """ Drop our lease, storing 'result' (if any) in the same commit """
+        db = self.connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            if result is not None:
+                db.execute(
+                    "INSERT OR REPLACE INTO fetches VALUES (?, ?, ?)",
+                    (source, time.time(), json.dumps(result)),
+                )
+
+            db.execute(
+                "DELETE FROM leases WHERE source=? AND holder=?", (source, self.holder)
+            )
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    def get(self, source, refresh):
+        """ Return the shared result for 'source'.
+
+        If it's missing or stale and nobody else is fetching it, we call
+        refresh(previous) (where 'previous' is the stale result or None)
+        and share what it returns. Results must be JSON serializable.
+        """
+        announced = False
+        while True:
+            fetchedAt, result = self.read(source)
+            if fetchedAt and time.time() - fetchedAt < self.maxAge:
+                return result
+
+            if self.acquire(source):
+                # Somebody may have finished between our read and the lease
+                fetchedAt, result = self.read(source)
+                if fetchedAt and time.time() - fetchedAt < self.maxAge:
+                    self.release(source)
+                    return result
+
+                fresh = None
+                try:
+                    fresh = refresh(result)
+                finally:
+                    # On failure the next instance to ask tries instead
+                    self.release(source, fresh)
+
+                return fresh
+
+            if not announced:
+                print("Waiting for another instance to fetch", source)
+                announced = True
+
+            time.sleep(POLL_SECONDS)
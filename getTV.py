@@ -1,201 +1,112 @@
 #!/usr/bin/env python3
 
-import re
 import os
 import sys
 import time
-import bisect
-import sqlite3
+import atexit
 import argparse
 import platform
 import datetime
-import requests
 import subprocess
 import configparser
-import urllib.parse
-
-from operator import itemgetter
-
-import requests
-from requests_toolbelt.adapters.source import SourceAddressAdapter
 
 import webScrapeFetch
+from torrentApi import TorrentApiController, TokenCache
+from providers import (
+    ListingAggregator,
+    ScrapeProvider,
+    TorrentApiProvider,
+    TorrentApiSearchProvider,
+    infohashFromMagnet,
+)
+from magnetCache import MagnetCache
+from releaseParser import parseRelease
+from showIndex import ShowListWatcher
+from downloadIndex import DownloadIndex
+from downloadStore import DownloadStore
+from transmissionRpc import TransmissionClient
+from fleetCache import SharedFetchCache
+from egressPool import EgressPool
+from upstreamDigest import UpstreamDigest, fileSignature
+from retryPolicy import policy
+import metrics
+import debugCapture
 
 system = platform.system()
 
 
-class TorrentApiController:
-    def __init__(self, request, proxies={}):
-        # API docs: https://torrentapi.org/apidocs_v2.txt
-        self.BASE = "https://torrentapi.org/pubapi_v2.php?app_id=getTV&"
-        self.token = None
-        self.requestsFromSource = request  # must conform to 'requests' API
-        self.proxs = proxies
-        self.tokenAcquiredAt = None
-
-    def get(self, url):
-        return self.requestsFromSource.get(url, proxies=self.proxs, timeout=(5, 5))
-
-    def invalidateToken(self):
-        self.token = None
-        self.tokenAcquiredAt = None
-
-    def isTokenValid(self):
-        if self.token:
-            # tokens are only valid for 15 minutes
-            tokenValidForSeconds = 15 * 60
-            now = time.time()
-            tokenValid = (now - self.tokenAcquiredAt) < tokenValidForSeconds
-
-            if tokenValid:
-                return True
-
-            self.invalidateToken()
-            return False
-        return False
-
-    def getToken(self):
-        if self.isTokenValid():
-            return self.token
+class TVTorrentController:
+    def __init__(self, config, mode, loadHistory=True):
+        self.dbFilename = "downloads.db"
+        self.showsFilename = "SHOWS"
+        self.tokenFilename = ".torrentapi-token"
+        self.digestFilename = ".upstream-digest"
+        self.sourceIPs = []
+        self.proxies = []
+        self.quarantineSeconds = 600
+        self.transmissionHostRemote = ""
+        self.userpass = ""
+        self.downloadQuality = [720, 1080]
+        self.speakDownload = True
+        self.transmission = TransmissionClient("localhost:9091")
+        self.magnetCacheSize = 5000
+        self.magnetCacheDays = 7
 
-        TOKEN = {"get_token": "get_token"}
-        tokenURL = self.BASE + urllib.parse.urlencode(TOKEN)
+        # Minutes to wait for the best release of an episode before
+        # downloading it (per show overrides in SHOWS); 0 never waits
+        self.holdBack = 0
 
-        # loop because sometimes the API has temporary failures
-        while True:
-            try:
-                r = self.get(tokenURL)
-            except KeyboardInterrupt:
-                # Allow CTRL-C during downloads
-                raise
-            except BaseException:
-                print("Connection error when attempting to fetch API token")
-                time.sleep(5)
-                continue
+        # Optional metrics exports ([metrics] in tv.conf)
+        self.metricsPort = None
+        self.statsFilename = None
+        self.mode = mode
 
-            self.tokenAcquiredAt = time.time()
-
-            if r.status_code != 200:
-                # The API is fronted by cloudflare. Sometimes cloudflare
-                # throws up a captcha, which is annoying on remote servers,
-                # rendering our automation useless when it happens.
-                # Log the complete error page so we know what failed.
-                # If you get stuck by a cloudflare captcha block on your server,
-                # look into using a proxy instead.  See configuration file
-                # options under [network].
-                with open("output.html", "w") as err:
-                    err.write(r.text)
-
-                # Back off longer and wait for service to hopefully recover
-                print("Error getting API token. " "Wrote error to output.html")
-
-                time.sleep(300)
-
-            j = r.json()
-            if "token" in j:
-                self.token = j["token"]
-                return self.token
-            time.sleep(5)
-
-    # There are only two media queries: tv and movies
-    def loadCurrentSearchResultsTV(self):
-        return self.loadCurrentSearchResults("tv")
-
-    def loadCurrentSearchResultsMovies(self):
-        return loadCurrentSearchResults("movies")
-
-    def loadCurrentSearchResults(self, category):
-        while True:
-            # Generate URL *inside* the while loop because if the token
-            # expires during an error condition, we need to generate a
-            # new token and a new URL instead of infinite looping with an
-            # expired token that'll never return new results.
-            MOST_RECENT_100 = {
-                "mode": "list",
-                "category": category,
-                "sort": "last",
-                "limit": "100",
-                "token": self.getToken(),
-            }
-            mostRecentURL = self.BASE + urllib.parse.urlencode(MOST_RECENT_100)
+        # Listing providers to query every cycle ([sources] in tv.conf)
+        self.providerNames = [mode]
 
-            try:
-                r = self.get(mostRecentURL)
-            except KeyboardInterrupt:
-                # Allow CTRL-C during downloads
-                raise
-            except BaseException:
-                print("Connection error when attempting to fetch episodes")
-                time.sleep(5)
-                continue
+        # Fetch cache shared with other instances (fleet mode), if any
+        self.sharedCacheFilename = None
+        self.sharedCacheSeconds = 60
 
-            if r.status_code == requests.codes.too_many_requests:
-                print("Server denied token (known error). Retrying...")
-                time.sleep(5)
-                continue
+        # Per-show API searches ("search" provider)
+        self.searchesPerCycle = 30
+        self.searchConcurrency = 2
 
-            try:
-                j = r.json()
-            except BaseException:
-                print("JSON Parsing error...", r.text)
-                time.sleep(5)
-                continue
+        # Accepted links wait in the database outbox until the torrent
+        # client takes them. Failed deliveries are retried after
+        # retrySeconds, doubling every time up to maxRetrySeconds.
+        self.retrySeconds = 60
+        self.maxRetrySeconds = 3600
 
-            # Manually check for token error because sometimes 15 minute tokens
-            # don't seem to last for 15 minutes.
-            if "error" in j:
-                self.invalidateToken()
-                time.sleep(5)
-                continue
+        # Set by the daemon to wake its dispatcher instead of delivering
+        # queued links inline
+        self.wakeDispatcher = None
 
-            if "torrent_results" in j:
-                # Sort results from highest resolution to lowest resolution so
-                # if multiple downloads for the same release showing up at once,
-                # we'll trigger the higher quality download first.
-                # minor bug: only works with same-source, same-group releases.
-                #            if filename has multiple releases across multiple
-                #            groups, longer filename will sort after shorter
-                #            name regardless of prefix/resolution matching.
-                results = sorted(j["torrent_results"], key=itemgetter("filename"))
-
-                # We're consuming exactly the JSON returned by the API without
-                # any provider-independent intermediate representation.
-                # If the torrentapi.org return values change, we'll need to
-                # adjust how we use fields in other part of the code.
-                #
-                # We only use two fields from 'results' right now:
-                #   - 'filename'
-                #   - 'download' (the magnet link)
-                return results
-
-            print("torrent_results not found in JSON. Retrying.")
-            time.sleep(5)
+        # Set by upstreamUnchanged(); saved once a cycle completes cleanly
+        self.configFilenames = [config, config + ".local"]
+        self.pendingDigest = None
+        self.cycleComplete = True
 
+        self.establishConfiguration(config)
 
-class TVTorrentController:
-    def __init__(self, config, mode):
-        self.dbFilename = "downloads.db"
-        self.showsFilename = "SHOWS"
-        self.sourceIP = ""
-        self.transmissionHostRemote = ""
-        self.userpass = ""
-        self.downloadQuality = [720, 1080]
-        self.speakDownload = True
-        self.qualityOverride = {}
-        self.mode = mode
+        # Every upstream request (API and scraper) goes out through the
+        # healthiest configured source IP / proxy
+        self.egresses = EgressPool.fromAddresses(
+            self.sourceIPs, self.proxies, self.quarantineSeconds
+        )
+        webScrapeFetch.configure(egresses=self.egresses)
 
-        # We don't retain 'proxs' or 'requestsFromSource' in this
-        # instance since they get stored/retained inside TorrentApiController
-        proxs = {}
-        requestsFromSource = requests.Session()
+        self.torrentController = TorrentApiController(
+            self.egresses, {}, TokenCache(self.tokenFilename)
+        )
 
-        self.establishConfiguration(config, requestsFromSource, proxs)
-        self.torrentController = TorrentApiController(requestsFromSource, proxs)
+        self.showList = ShowListWatcher(self.showsFilename)
 
-        self.establishDatabase()
+        self.establishDatabase(loadHistory)
+        self.providers = self.establishProviders()
 
-    def establishConfiguration(self, configFilename, requestsFromSource, proxs):
-        config = configparser.SafeConfigParser(allow_no_value=True)
+    def establishConfiguration(self, configFilename):
+        config = configparser.ConfigParser(allow_no_value=True)
 
         configFilenameLocal = configFilename + ".local"
         if not (os.path.isfile(configFilename) or os.path.isfile(configFilenameLocal)):
@@ -222,16 +133,61 @@ class TVTorrentController:
         password = getOrNot("remote", "password")
         self.userpass = "{}:{}".format(username, password)
 
-        self.sourceIP = getOrNot("network", "fetchFromSourceIP")
-        proxs["https"] = getOrNot("network", "proxy")
+        # Talk to transmission-daemon over RPC ourselves unless configured
+        # to use the transmission-remote command instead
+        if (getOrNot("remote", "client") or "rpc") == "rpc":
+            self.transmission = TransmissionClient(
+                self.transmissionHostRemote or "localhost:9091", username, password
+            )
+        else:
+            self.transmission = None
+
+        self.retrySeconds = config.getfloat(
+            "remote", "retrySeconds", fallback=self.retrySeconds
+        )
+        self.maxRetrySeconds = config.getfloat(
+            "remote", "maxRetrySeconds", fallback=self.maxRetrySeconds
+        )
+
+        # Both accept a space separated list; requests are spread over
+        # every (source IP, proxy) combination
+        self.sourceIPs = (getOrNot("network", "fetchFromSourceIP") or "").split()
+        self.proxies = (getOrNot("network", "proxy") or "").split()
+        self.quarantineSeconds = config.getfloat(
+            "network", "quarantineSeconds", fallback=self.quarantineSeconds
+        )
 
         self.dbFilename = getOrNot("files", "db")
         self.showsFilename = getOrNot("files", "shows")
+        self.tokenFilename = getOrNot("files", "token") or self.tokenFilename
+
+        # Empty disables the unchanged upstream check
+        self.digestFilename = config.get(
+            "files", "digest", fallback=self.digestFilename
+        )
+
+        providerNames = getOrNot("sources", "providers")
+        if providerNames:
+            self.providerNames = providerNames.split()
+
+        self.sharedCacheFilename = getOrNot("sources", "sharedCache")
+        self.sharedCacheSeconds = config.getfloat(
+            "sources", "sharedCacheSeconds", fallback=self.sharedCacheSeconds
+        )
+
+        self.searchesPerCycle = config.getint(
+            "search", "perCycle", fallback=self.searchesPerCycle
+        )
+        self.searchConcurrency = config.getint(
+            "search", "concurrency", fallback=self.searchConcurrency
+        )
 
         self.speakDownload = config.getboolean(
             "content", "speakDownload", fallback=False
         )
 
+        self.holdBack = config.getfloat("content", "holdBack", fallback=self.holdBack)
+
         resolutions = getOrNot("content", "quality")
         if resolutions:
             # Strip 'p' if users entered '720p 1080p'
@@ -240,183 +196,101 @@ class TVTorrentController:
                 int(r) for r in resolutions.replace("p", "").split(" ")
             ]
 
-        # Bind specific source interface to https requestor (or not)
-        requestsFromSource.mount("https://", SourceAddressAdapter(self.sourceIP or ""))
+        self.magnetCacheSize = config.getint(
+            "scrape", "magnetCacheSize", fallback=self.magnetCacheSize
+        )
+        self.magnetCacheDays = config.getfloat(
+            "scrape", "magnetCacheDays", fallback=self.magnetCacheDays
+        )
 
-    def establishDatabase(self):
-        self.conn = sqlite3.connect(self.dbFilename)
-        self.c = self.conn.cursor()
+        concurrency = getOrNot("scrape", "concurrency")
+        requestsPerSecond = getOrNot("scrape", "requestsPerSecond")
+        webScrapeFetch.configure(
+            concurrency=int(concurrency) if concurrency else None,
+            requestsPerSecond=float(requestsPerSecond) if requestsPerSecond else None,
+            parser=getOrNot("scrape", "parser"),
+        )
 
-        # Always try to create the database; it's a no-op if already exists
-        try:
-            self.c.execute(
-                """CREATE TABLE episodes
-                              (show, episode, quality, reencode,
-                               uncensored, westlive,
-                               UNIQUE (show, episode, quality, reencode,
-                                       uncensored, westlive)
-                               ON CONFLICT ABORT)"""
-            )
-            self.c.execute(
-                """CREATE INDEX epidx ON episodes
-                              (show, episode, quality, reencode,
-                               uncensored, westlive)"""
-            )
-            self.conn.commit()
-        except BaseException:
-            pass
+        self.metricsPort = config.getint("metrics", "port", fallback=None)
+        self.statsFilename = getOrNot("metrics", "statsFile")
+
+        captureMegabytes = config.getfloat("debug", "captureMegabytes", fallback=None)
+        debugCapture.ring.configure(
+            mode=getOrNot("debug", "capture"),
+            directory=getOrNot("debug", "captureDir"),
+            maxEntries=config.getint("debug", "captureEntries", fallback=None),
+            maxBytes=int(captureMegabytes * (1 << 20)) if captureMegabytes else None,
+            compress=config.getboolean("debug", "captureCompress", fallback=None),
+        )
+
+        policy.configure(
+            attempts=config.getint("retry", "attempts", fallback=None),
+            maxDelay=config.getfloat("retry", "maxDelay", fallback=None),
+            failureThreshold=config.getint("retry", "failureThreshold", fallback=None),
+        )
+
+    def establishDatabase(self, loadHistory=True):
+        # Creates or migrates the database schema as needed
+        self.store = DownloadStore(self.dbFilename)
+
+        self.magnetCache = MagnetCache(
+            self.store,
+            maxEntries=self.magnetCacheSize,
+            maxAge=self.magnetCacheDays * 24 * 60 * 60,
+        )
+
+        if loadHistory:
+            self.loadHistory()
+
+    def loadHistory(self):
+        # Duplicate checks run against memory; the DB is only written to.
+        # This is the slow part of starting up, so cron runs only do it
+        # once they know there's something to select (upstreamUnchanged()).
+        self.downloads = DownloadIndex.fromSelections(self.store.selections())
 
     def fetchEpisodeList(self):
         return self.torrentController.loadCurrentSearchResultsTV()
 
     def loadShowList(self):
-        """ Load local list of shows to download.
+        """ Load local list of shows to download as a ShowIndex.
 
-        We don't cache results of self.showsFilename parsing because we want
-        to pick up any updates to the file each time we search episodes
-        (it's a quick operation anyway).
+        The parsed list is cached and only re-parsed when SHOWS (or
+        SHOWS.local) changes, so edits are still picked up on the next
+        search without re-reading the file every cycle.
         """
-
-        # if SHOWS.local exists, use it *instead* of SHOWS
-        # otherwise, use SHOWS directly (no additional extension added)
-        useFilename = self.showsFilename + ".local"
-        if not os.path.isfile(useFilename):
-            useFilename = self.showsFilename
-
-        s = []
-        with open(useFilename, "r") as shows:
-            for line in shows:
-                # Allow blank lines and start-of-line comments
-                if line != "\n" and line[0] != "#":
-                    showNameFromFile = line.rstrip()
-
-                    # Show filenames won't have extraneous punctuation
-                    # even if it's the proper canonical form of the show name,
-                    # so strip filename-interfering punctuation
-                    showNameFromFile = re.sub(r"['.]", "", showNameFromFile)
-
-                    # If show has a quality override identifier, store into
-                    # quality override dict (and repair name for s.append())
-                    if "-" in showNameFromFile:
-                        # Format of override is (example):
-                        # show name anything - 1080p
-                        match = r"\s?-\s?(720|1080|2160)p"
-                        foundOverride = re.search(match, showNameFromFile)
-                        if foundOverride:
-                            # Remove quality identifier from compare name
-                            showNameFromFile = re.sub(match, "", showNameFromFile)
-
-                            # Store quality override for later usage
-                            self.qualityOverride[showNameFromFile] = [
-                                int(foundOverride.group(1))
-                            ]
-
-                    # Allow for case insensitive name matches so users
-                    # don't have to worry about names like "iZombie, ONeals"
-                    s.append(showNameFromFile.lower())
-
-        # Sort here because we use a binary search to narrow down selections
-        s.sort()
-
-        return s
+        return self.showList.current()
 
     def showEpisodeQualityExtraFromFilename(self, filename):
-        """Extract metadata from filename.
+        """Extract metadata from filename (see releaseParser.parseRelease)
 
-        On success, return a tuple of extracted:
-            (show, episode, quality, extra, reencode, uncensored, westLive)
+        On success, return a Release of extracted:
+            (show, episode, quality, reencode, uncensored, westLive)
         On failure to decode filename to components, return None
+        """
+        return parseRelease(filename)
 
-        Examples:
-        Adventure.Time.S07E02.Varmints.720p.HDTV.x264-W4F[rarbg]
-        The.Simpsons.S27E06.PROPER.720p.HDTV.x264-KILLERS[rarbg]
-        Stephen.Colbert.2016.09.01.Larry.Wilmore.720p.CBS.WEBRip.AAC2.0.x264-RTN
-        The.Simpsons.S27E21.WEST.FEED.720p.HDTV.x264-BATV[rartv]
-        Mr.Robot.S02E07.UNCENSORED.1080p.WEB.X264-DEFLATE[rartv]
+    def qualifiesForSelection(self, filename, qualityOverride=None, entry=None):
+        """ Return the parsed Release for 'filename' if it should be
+        downloaded, otherwise False. 'entry' is the ShowEntry it matched. """
+        release = self.showEpisodeQualityExtraFromFilename(filename)
+        if not release:
+            return False
 
-        Updated to verify these two filenames are detected as the same episode:
-        Will.and.Grace.S10E13.720p.HDTV.x264-LucidTV[rarbg]
-        Will.And.Grace.S10E13.iNTERNAL.720p.WEB.h264-BAMBOOZLE[rarbg]
-        """
-        show = None
-        episode = None
-
-        # quality is 480p by default because 480p downloads have no quality tag,
-        # so '480' is the default passthrough value. 720/1080 will override
-        # 'quality' because they get extracted from filename details.
-        # Also note: we don't have an explicit option for 540p, but 540p will
-        #            fallback to the 480p selector.
-        quality = 480
-        reencode = False
-        uncensored = False
-        westLive = False
-
-        # Show name is immediately before the S00E00 or date marker
-        # (2016.01.01)
-        nameMatch = re.match(r"(.*?)\.(\d\d\d\d|S\d\d)", filename)
-        if not nameMatch:
-            return None
-
-        # Convert show name dot delimiters back to spaces
-        show = nameMatch.group(1).replace(".", " ")
-
-        episodeNumber = re.search(r"S\d\dE\d\d", filename)
-        episodeDate = re.search(r"\d\d\d\d\.\d\d\.\d\d", filename)
-        # Prefer episode numbers, but fall back to dates if that's all we have
-        if episodeNumber:
-            episode = episodeNumber.group(0)
-        elif episodeDate:
-            episode = episodeDate.group(0)
-        else:
-            # else, not a single episode (by S00E00 or by date), so skip.
-            # otherwise, this would catch entire season/series
-            # compilations tagged as e.g. Show.Name.S03
-            return None
-
-        # 480p has no quality tag and we set 480 as the default above, so
-        # in the case of 480p, nothing matches and we assume it's not HD
-        # (Basically: any resolution *not* in the regex below falls
-        #             back to a default of 480p (that includes 540p))
-        qualityMatch = re.search(r"(720|1080|2160)", filename)
-        if qualityMatch:
-            quality = int(qualityMatch.group(1))
-
-        # If filename is a re-encode (REPACK or PROPER), then it's okay
-        # to allow a duplicate selection of a previously seen episode
-        # because the old one is known to be bad/corrupt/improper.
-        reencodeMatch = re.finditer(r"(REPACK|PROPER)", filename)
-        reencode = 0
-        # Sometimes there's a rare REPACK.PROPER and we'd need to
-        # redownload that one too. Just increase re-encode for each
-        # re-encode update designator.
-        for match in reencodeMatch:
-            reencode += 1
-
-        # Also download UNCENSORED episodes as new even if the episode
-        # has been previously downloaded. Typically gets posted a few days
-        # to a week after the original TV airing
-        # (as happens with southpark, mr robot, etc).
-        uncensoredMatch = re.search(r"UNCENSORED", filename, flags=re.IGNORECASE)
-        if uncensoredMatch:
-            uncensored = True
-
-        # If a show is live, they usually do two versions: one for
-        # the east coast (the "regular version") and then again
-        # three hours later for the west coast.  The second airing
-        # gets tagged with a WEST identifier and the same episode number.
-        westLiveMatch = re.search(r"WEST\.FEED", filename)
-        if westLiveMatch:
-            westLive = True
-
-        # We normalize 'show' case because we rely on the sqlite3
-        # uniqueness constaints to prevent duplicate downloads, but some
-        # episodes are posted multiple times with multiple cases (e.g.
-        # sometimes And or With are capitalized, othertimes not, and then
-        # we get duplicate downloads of the same episode which is bad
-        # if our network connections have data caps).
-        return (show.title(), episode, quality, reencode, uncensored, westLive)
-
-    def qualifiesForSelection(self, filename):
+        if entry:
+            release = self.canonicalRelease(release, entry)
+
+        return self.releaseQualifies(release, qualityOverride)
+
+    def canonicalRelease(self, release, entry):
+        """ 'release' under the first name on its SHOWS line if it matched
+        an alias, so every alias of a show shares one download history """
+        if entry.name == entry.canonical:
+            return release
+
+        # Same normalization parseRelease() applies to show names
+        return release._replace(show=entry.canonical.title())
+
+    def releaseQualifies(self, release, qualityOverride=None):
         def fileAlreadySelected(details):
             # Check if episode:
             #   - was exactly downloaded already for show+ep
@@ -426,44 +300,22 @@ class TVTorrentController:
             #     - OR -
             #   - needs to download anyway because we have extra tags tag due
             #     to an alternate encoding/release with different material
-            if (
-                self.c.execute(
-                    """SELECT * FROM episodes WHERE
-                                 show=? AND
-                                 episode=? AND
-                                 quality >= ? AND
-                                 reencode >= ? AND
-                                 uncensored=? AND
-                                 westlive=?""",
-                    details,
-                )
-                and self.c.fetchone()
-            ):
-                return True
+            return self.downloads.alreadySelected(details)
 
-            # else, the combination of show+ep (from 'filename') hasn't been
-            # seen before.
-            return False
-
-        # Process 'filename' and determine if selection should happen
-        details = self.showEpisodeQualityExtraFromFilename(filename)
-        if details:
-            (show, episode, quality, _, _, _) = details
-        else:
-            return False
+        # Determine if selection of an already parsed release should happen
+        details = release
+        (show, episode, quality, _, _, _) = details
 
         def downloadThisFile():
             if fileAlreadySelected(details):
                 print("Skipping {} {} ({})".format(show, episode, quality))
                 return False
-            return True
+            return release
 
-        # abstraction leakage; our override names are lowercase
-        # because that's how we're comparing them on injest from user
-        checkOverrideShowName = show.lower()
-        if checkOverrideShowName in self.qualityOverride:
-            if quality in self.qualityOverride[checkOverrideShowName]:
-                return downloadThisFile()
+        # Per-show quality overrides (from the SHOWS file) are allowed
+        # in addition to the globally configured qualities
+        if qualityOverride and quality in qualityOverride:
+            return downloadThisFile()
 
         if quality in self.downloadQuality:
             return downloadThisFile()
@@ -471,70 +323,400 @@ class TVTorrentController:
         return False
 
     def showShouldBeSelected(self, shows, filename):
-        """ If 'filename' is valid show at valid quality, allow download. """
+        """ If 'filename' is valid show at valid quality, allow download.
+
+        'shows' is the ShowIndex from loadShowList(). Returns the parsed
+        Release when selected, otherwise False. """
 
         # if shows list is empty, we can't do anything
         if not shows:
             return False
 
-        # Instead of linear lookup with an average 3,500 lookups per run
-        # (100 API results * 70 shows in show list = 7,000 lookups, but on
-        #  average we'd only need to ask half the list per lookup, so that
-        #  ends up being 100 * (70/2) = 3,500)
-        # we use sorted show list and binary search for an improved average
-        # of 425 lookups per run
-        # (100 API results * log(70 shows in show list) = 424.85).
-        def showExistsInShowList(shows, filename):
-            # 'lowerFile' is the inbound filename we are searching for a match
-            # lower() because we want case insensitive matches and we already
-            # lower()'d the entire SHOWS list when we parsed it.
-            # Replacing dots because our show names are space delimited.
-            lowerFile = filename.replace(".", " ").lower()
-
-            showPosition = bisect.bisect_left(shows, lowerFile)
-            if showPosition != 0:
-                # (because filenames are longer than our show names,
-                #  filenames always sort +1 higher than the show name itself)
-                showPosition -= 1
-
-            # Extracted selected binary search'd shows from 'shows'
-            currentShow = shows[showPosition]
-
-            # Check if inbound filename is a prefix match of the binary search
-            # location selected by bisect_left()
-            if lowerFile.startswith(currentShow):
-                # If show has a "DO NOT PERFORM A PREFIX MATCH" designator,
-                # verify the match is exact and NOT just a prefix of longer
-                # name
-                if currentShow.endswith("$") and lowerFile != currentShow:
-                    return False
-
-                return True
+        # Trie lookup visits each filename character at most once no matter
+        # how many shows we track, and handles show names that are prefixes
+        # of other show names.
+        entry = shows.match(filename)
+        if entry:
+            return self.qualifiesForSelection(filename, entry.quality, entry)
+
+        return False
+
+    def enqueue(self, details, magnetLink, filename):
+        # Selected from now on, even before the torrent client has it
+        self.store.enqueue(details, magnetLink, filename)
+        self.downloads.add(details)
+
+    def verifyDownloadIndex(self):
+        """ Report any difference between in-memory selections and the DB """
+        differ = self.downloads.verify(self.store.selections())
+        for key, inMemory, inDatabase in differ:
+            print(
+                "Download index mismatch for {}: memory {} database {}".format(
+                    key, inMemory, inDatabase
+                )
+            )
+
+        return not differ
+
+    def establishProviders(self):
+        """ Build the configured listing providers (see [sources] in tv.conf) """
+        sharedCache = None
+        if self.sharedCacheFilename:
+            sharedCache = SharedFetchCache(
+                self.sharedCacheFilename, maxAge=self.sharedCacheSeconds
+            )
+
+        available = {
+            "api": lambda: TorrentApiProvider(self.torrentController, sharedCache),
+            "scrape": lambda: ScrapeProvider(self.store, sharedCache),
+            "search": lambda: TorrentApiSearchProvider(
+                self.torrentController,
+                self.showList,
+                self.store,
+                perCycle=self.searchesPerCycle,
+                concurrency=self.searchConcurrency,
+            ),
+        }
+
+        providers = []
+        for name in self.providerNames:
+            if name not in available:
+                print("Unknown provider {}; ignoring".format(name))
+                continue
+
+            providers.append(available[name]())
+
+        return providers
 
+    def upstreamUnchanged(self):
+        """ True if the newest listings of every provider (and our SHOWS
+        and config files) are exactly what the last completed run saw.
+
+        Costs one request per provider; the cycle that follows reuses what
+        was fetched. Providers that can't tell from one page (per-show
+        searches) always count as changed.
+        """
+        if not self.digestFilename:
             return False
 
-        if showExistsInShowList(shows, filename):
-            return self.qualifiesForSelection(filename)
+        pages = []
+        for provider in self.providers:
+            try:
+                page = provider.newestPage()
+            except Exception as e:
+                print("Couldn't check {} for changes: {}".format(provider.name, e))
+                return False
 
-        return False
+            if page is None:
+                return False
 
-    def selectNewEpisodes(self):
-        """ The main selection processor """
+            pages.append([provider.name, page])
+
+        # Editing SHOWS or the config can select listings we skipped before
+        inputs = [
+            fileSignature(filename)
+            for filename in self.configFilenames
+            + [self.showsFilename, self.showsFilename + ".local"]
+        ]
+
+        self.pendingDigest = UpstreamDigest.of([inputs, pages])
+        return self.pendingDigest == UpstreamDigest(self.digestFilename).load()
+
+    def upstreamAvailable(self):
+        """ True if any configured provider isn't behind an open circuit """
+        return any(provider.available() for provider in self.providers)
+
+    def fetchEpisodePages(self):
+        """ Yield batches of Listing as they arrive from all providers.
+
+        Every provider is queried concurrently; the same torrent listed
+        by more than one provider is only yielded by whichever listed it
+        first. """
+        self.listings = ListingAggregator(self.providers)
+        return self.listings.batches()
+
+    def processResults(self, shows, results):
+        """ Match, resolve, and dispatch one batch of Listing """
+
+        # Collect every result we want before resolving any links so the
+        # scraper can fetch all episode pages in parallel. Keep each parsed
+        # release with its result so nothing gets parsed twice.
+        candidates = []
+        matched = []
+        with metrics.phaseSeconds.time(phase="match"):
+            for result in results:
+                entry = shows.match(result.filename)
+                if entry:
+                    matched.append((result, entry))
+
+        with metrics.phaseSeconds.time(phase="dedup"):
+            for result, entry in matched:
+                release = self.qualifiesForSelection(
+                    result.filename, entry.quality, entry
+                )
+                if release:
+                    candidates.append((result, release, entry))
 
-        def recordSelection(details):
-            self.c.execute("INSERT INTO episodes VALUES (?, ?, ?, ?, ?, ?)", details)
-            self.conn.commit()
+        metrics.listings.inc(len(results) - len(matched), outcome="skipped")
+        metrics.listings.inc(len(matched), outcome="matched")
+        metrics.listings.inc(len(matched) - len(candidates), outcome="rejected")
 
-        # Fetch most recent 100 tv torrents from provider
-        print("Asking TV torrent API for list of shows ready for download...")
-        start = time.time()
-        if self.mode == "api":
-            results = self.fetchEpisodeList()
+        if not candidates:
+            return
+
+        # Some providers list magnet links directly, others only link to a
+        # page we have to fetch for its magnet link. We only fetch pages we
+        # haven't already resolved before.
+        pages = [result.episodePage for result, _, _ in candidates if not result.magnet]
+        with metrics.phaseSeconds.time(phase="resolve"):
+            links = self.magnetCache.getMany(pages)
+
+            fetched = webScrapeFetch.magnetLinksFromURLs(
+                page for page in pages if page not in links
+            )
+            self.magnetCache.putMany(fetched)
+
+        links.update(fetched)
+
+        def getLinkForFilename(result, filename):
+            if result.magnet:
+                return result.magnet
+
+            magnetLink = links.get(result.episodePage)
+            if not magnetLink:
+                # Fetch failed; the next cycle lists it again to retry
+                self.cycleComplete = False
+                self.listings.unresolved(result)
+                return None
+
+            # Now that we know its infohash, skip it if another provider
+            # already listed the same torrent this cycle.
+            if not self.listings.claim(infohashFromMagnet(magnetLink)):
+                return None
+
+            return magnetLink
+
+        # Decide everything we'll download from this batch in result order
+        # (highest resolution first). 'batch' stands in for the database
+        # until the links are queued, so a 720p after an accepted 1080p
+        # of the same episode is still skipped.
+        batch = DownloadIndex()
+        accepted = []
+        for result, details, entry in candidates:
+            filename = result.filename
+
+            if batch.alreadySelected(details):
+                continue
+
+            # Re-check because the episode may have been recorded since
+            # this candidate was matched.
+            if not self.releaseQualifies(details, entry.quality):
+                continue
+
+            # Verify the link is properly formed
+            magnetLink = getLinkForFilename(result, filename)
+            if not magnetLink or not magnetLink.startswith("magnet:?"):
+                continue
+
+            batch.add(details)
+
+            holdBack = self.holdBack if entry.holdBack is None else entry.holdBack
+            if holdBack > 0:
+                self.holdRelease(details, magnetLink, filename, holdBack)
+                continue
+
+            accepted.append((details, magnetLink, filename))
+
+        metrics.listings.inc(len(accepted), outcome="accepted")
+
+        self.handOff(accepted)
+
+    def holdRelease(self, details, magnetLink, filename, minutes):
+        """ Hold 'details' back for up to 'minutes' in case a better release
+        of the same episode shows up; releaseDueHolds() dispatches the best
+        one held once the first one held has waited long enough. """
+        deadline = time.time() + minutes * 60
+        if self.store.hold(details, magnetLink, filename, deadline):
+            metrics.listings.inc(outcome="held")
+            print("Holding {} in case a better release shows up".format(filename))
+
+    def holdsDue(self):
+        """ True if anything held back is ready to dispatch """
+        deadline = self.store.nextHoldDeadline()
+        return deadline is not None and deadline <= time.time()
+
+    def releaseDueHolds(self):
+        """ Dispatch the best release of every episode whose hold-back
+        window has passed (unless it's been selected some other way) """
+        accepted = []
+        for details, magnetLink, filename in self.store.dueHolds(time.time()):
+            if self.downloads.alreadySelected(details):
+                self.store.dropHold(details)
+                continue
+
+            accepted.append((details, magnetLink, filename))
+
+        self.handOff(accepted)
+
+    def handOff(self, accepted):
+        """ Select 'accepted' and queue its links for the torrent client """
+        if not accepted:
+            return
+
+        for details, magnetLink, filename in accepted:
+            self.enqueue(details, magnetLink, filename)
+
+        # Once committed, queued links survive crashes and client outages
+        self.store.commit()
+        self.dispatchQueued()
+
+    def dispatchQueued(self):
+        """ Deliver queued links now, or wake the daemon's dispatcher """
+        if self.wakeDispatcher:
+            self.wakeDispatcher()
         else:
-            results = webScrapeFetch.fetchEpisodeList()
-        end = time.time()
-        print("Downloaded current episode list in {:.2f} seconds".format((end - start)))
+            self.deliverQueued()
+
+    def deliveriesDue(self):
+        """ True if any queued link is ready for (another) delivery attempt """
+        attemptAt = self.store.nextDeliveryAttempt()
+        return attemptAt is not None and attemptAt <= time.time()
+
+    def deliverQueued(self):
+        """ Hand every queued link that's due to the torrent client.
+
+        Links the client doesn't take stay queued and are retried on their
+        own schedule (see retrySeconds), never by fetching upstream again.
+        """
+        due = self.store.dueDeliveries(time.time())
+        if not due:
+            return
+
+        with metrics.phaseSeconds.time(phase="dispatch"):
+            added = set(
+                self.dispatch(
+                    [
+                        (details, magnetLink, filename)
+                        for details, magnetLink, filename, _ in due
+                    ]
+                )
+            )
+
+        metrics.listings.inc(len(added), outcome="dispatched")
+
+        for details, _, filename, attempts in due:
+            if details in added:
+                self.store.delivered(details)
+                continue
+
+            # Cap the exponent: links can stay queued for months, and a
+            # float retrySeconds overflows past 2**1023
+            backoff = 2 ** min(attempts, 30)
+            delay = min(self.maxRetrySeconds, self.retrySeconds * backoff)
+            self.store.deferDelivery(details, time.time() + delay)
+            print("Will retry {} in {:.0f} seconds".format(filename, delay))
+
+        self.store.commit()
+
+    def dispatch(self, accepted):
+        """ Hand magnet links to the torrent client.
+
+        'accepted' is a list of (details, magnetLink, filename).
+        Returns details of each link the client actually accepted; anything
+        else stays queued for a later attempt.
+        """
+        if system == "Linux" and self.transmission:
+            # One RPC session for the whole batch
+            for _, _, filename in accepted:
+                print("Downloading", filename)
+
+            results = self.transmission.addMagnets(
+                [magnetLink for _, magnetLink, _ in accepted]
+            )
+
+            added = []
+            for (details, _, filename), (_, ok, error) in zip(accepted, results):
+                if ok:
+                    added.append(details)
+                else:
+                    print("Failed to add {}: {}".format(filename, error))
+
+            return added
+
+        added = []
+        for details, magnetLink, filename in accepted:
+            (show, _, _, _, _, _) = details
+
+            print("Downloading", filename)
+
+            try:
+                if system == "Darwin":
+                    # On OS X, open magnet links directly with whichever
+                    # app is registered for the filetype with the OS.
+                    subprocess.check_call(
+                        [
+                            "/usr/bin/open",
+                            "-g",  # don't bring to foreground
+                            magnetLink,
+                        ]
+                    )
+                    if self.speakDownload:
+                        # Note: no error checking here because 'say'
+                        # failure doesn't impact link opening success.
+                        subprocess.call(["/usr/bin/say", "Downloading {}".format(show)])
+                elif system == "Linux":
+                    # On Linux, connect to transmission-daemon remotely
+                    subprocess.check_call(
+                        [
+                            "transmission-remote",
+                            self.transmissionHostRemote,
+                            "-n",
+                            self.userpass,
+                            "-a",
+                            magnetLink,
+                        ]
+                    )
+            except (subprocess.CalledProcessError, OSError):
+                # Either opening the link or connecting to remote
+                # transmission instance failed (or the command is missing),
+                # so keep this download queued.
+                continue
+
+            added.append(details)
+
+        return added
+
+    def selectNewEpisodes(self):
+        """ The main selection processor
+
+        Runs as a streaming pipeline: each batch of results is matched and
+        dispatched as soon as it arrives, so new downloads start while the
+        scraper is still fetching older index pages. """
+
+        self.cycleComplete = True
+        try:
+            with metrics.cycleSeconds.time():
+                self.selectionCycle()
+
+            # Next cron run can stop early if upstream still looks like this
+            # (unless something here needs retrying by the next cycle)
+            complete = self.cycleComplete and not self.listings.failures
+            if self.pendingDigest and complete:
+                UpstreamDigest(self.digestFilename).save(self.pendingDigest)
+
+            self.pendingDigest = None
+        finally:
+            # Failed cycles are exactly the ones worth looking at
+            if self.statsFilename:
+                try:
+                    metrics.registry.writeJSON(self.statsFilename)
+                except OSError as e:
+                    print("Couldn't write stats to", self.statsFilename, e)
+
+        completedAt = str(datetime.datetime.now())
+        print("Done processing shows at", completedAt)
 
+    def selectionCycle(self):
         # Read local SHOWS text file (or its override file)
         start = time.time()
         shows = self.loadShowList()
@@ -545,67 +727,152 @@ class TVTorrentController:
             )
         )
 
-        def getLinkForFilename(result, filename):
-            # API mode has URL directly in the result
-            if self.mode == "api":
-                return result["download"]
+        # Fetch most recent tv torrents from provider
+        print("Asking TV torrent API for list of shows ready for download...")
+        start = time.time()
+        firstBatchAt = None
+        count = 0
+        try:
+            # Held releases whose wait is over (and links the torrent client
+            # refused earlier) go out before we look for more
+            self.releaseDueHolds()
+            self.dispatchQueued()
+
+            for results in self.fetchEpisodePages():
+                if firstBatchAt is None:
+                    firstBatchAt = time.time()
+                    print(
+                        "Downloaded first episode list in {:.2f} seconds".format(
+                            firstBatchAt - start
+                        )
+                    )
 
-            # Scaper has to fetch URL from another web request
-            return webScrapeFetch.magnetLinkFromURL(result["episodePage"])
+                count += len(results)
+                self.processResults(shows, results)
 
-        for result in results:
-            filename = result["filename"]
+            end = time.time()
+            print("Processed {} results in {:.2f} seconds".format(count, (end - start)))
 
-            if self.showShouldBeSelected(shows, filename):
-                details = self.showEpisodeQualityExtraFromFilename(filename)
-                (show, episode, quality, _, _, _) = details
+            self.magnetCache.evict()
+        finally:
+            # One transaction per cycle apart from queued links (even if the
+            # cycle failed part way, anything we already did must be kept)
+            self.store.commit()
 
-                # Verify the link is properly formed
-                magnetLink = getLinkForFilename(result, filename)
-                if not magnetLink.startswith("magnet:?"):
-                    continue
 
-                print("Downloading", result["filename"])
+async def runForever(runner, interval, checkDB=False):
+    """ Run selection cycles every 'interval' seconds until SIGTERM/SIGINT.
 
-                try:
-                    if system == "Darwin":
-                        # On OS X, open magnet links directly with whichever
-                        # app is registered for the filetype with the OS.
-                        subprocess.check_call(
-                            [
-                                "/usr/bin/open",
-                                "-g",  # don't bring to foreground
-                                magnetLink,
-                            ]
-                        )
-                        if self.speakDownload:
-                            # Note: no error checking here because 'say'
-                            # failure doesn't impact link opening success.
-                            subprocess.call(
-                                ["/usr/bin/say", "Downloading {}".format(show)]
-                            )
-                    elif system == "Linux":
-                        # On Linux, connect to transmission-daemon remotely
-                        subprocess.check_call(
-                            [
-                                "transmission-remote",
-                                self.transmissionHostRemote,
-                                "-n",
-                                self.userpass,
-                                "-a",
-                                magnetLink,
-                            ]
-                        )
-                except subprocess.CalledProcessError:
-                    # Either opening the link or connecting to remote
-                    # transmission instance failed, so don't record this
-                    # download as a success yet.
-                    # Posting the download will retry again if
-                    # the episode is still in the next result set.
-                    continue
-                recordSelection(details)
-        completedAt = str(datetime.datetime.now())
-        print("Done processing shows at", completedAt)
+    Cycles start on a fixed wall clock cadence no matter how long each one
+    takes (a cycle running past its slot skips the missed slots instead of
+    piling up). Accepted links are queued in the database and delivered by
+    a separate dispatcher task with its own retry schedule, so delivering
+    downloads overlaps fetching and a torrent client outage costs no extra
+    upstream requests.
+    """
+    # Only the daemon needs these; cron runs skip importing them
+    import signal
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    ready = asyncio.Event()
+
+    def wakeDispatcher():
+        # Called from the selection thread
+        loop.call_soon_threadsafe(ready.set)
+
+    runner.wakeDispatcher = wakeDispatcher
+
+    if runner.metricsPort:
+        metrics.registry.serve(runner.metricsPort)
+        print("Serving metrics on port {} at /metrics".format(runner.metricsPort))
+
+    if "api" in runner.providerNames:
+        # Keep the API token fresh between cycles so no cycle waits on one
+        runner.torrentController.keepTokenFresh()
+
+    async def dispatcher():
+        # Deliver whatever is due, then sleep until the next retry is due
+        # or selection queues something new
+        while not stop.is_set():
+            ready.clear()
+            try:
+                await asyncio.to_thread(runner.deliverQueued)
+                attemptAt = runner.store.nextDeliveryAttempt()
+            except Exception as e:
+                print("Dispatch failed:", e)
+                attemptAt = time.time() + runner.retrySeconds
+
+            timeout = None
+            if attemptAt is not None:
+                timeout = max(0, attemptAt - time.time())
+
+            try:
+                await asyncio.wait_for(ready.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    dispatcherTask = asyncio.create_task(dispatcher())
+
+    nextRun = loop.time()
+    while not stop.is_set():
+        if not runner.upstreamAvailable():
+            # Every source is failing fast right now; don't spend a cycle on it
+            for endpoint, (state, failures, retryIn) in policy.status().items():
+                print(
+                    "{}: circuit {} after {} failures, retry in {:.0f}s".format(
+                        endpoint, state, failures, retryIn
+                    )
+                )
+            print("All sources unavailable; skipping this cycle")
+        else:
+            try:
+                await asyncio.to_thread(runner.selectNewEpisodes)
+            except Exception as e:
+                # Keep the daemon alive; the next cycle will try again
+                print("Selection cycle failed:", e)
+
+        if checkDB:
+            await asyncio.to_thread(runner.verifyDownloadIndex)
+
+        now = loop.time()
+        nextRun += interval
+        if nextRun <= now:
+            skipped = int((now - nextRun) // interval) + 1
+            print("Cycle overran its interval; skipping {} slot(s)".format(skipped))
+            nextRun += skipped * interval
+
+        nextAt = datetime.datetime.now() + datetime.timedelta(seconds=nextRun - now)
+        print("Next download attempt at {:%H:%M:%S}".format(nextAt))
+        sys.stdout.flush()
+
+        # Sleep until the next cycle, waking early whenever a hold-back
+        # deadline comes up so held releases don't wait for a cycle
+        while not stop.is_set() and now < nextRun:
+            wakeAt = nextRun
+            deadline = runner.store.nextHoldDeadline(after=time.time())
+            if deadline is not None:
+                wakeAt = min(wakeAt, now + deadline - time.time())
+
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=wakeAt - now)
+            except asyncio.TimeoutError:
+                pass
+
+            now = loop.time()
+            if wakeAt < nextRun and not stop.is_set():
+                await asyncio.to_thread(runner.releaseDueHolds)
+
+    # Anything undelivered stays queued for the next run
+    print("Stopping; waiting for the dispatcher to finish...")
+    ready.set()
+    await dispatcherTask
+    runner.store.commit()
 
 
 if __name__ == "__main__":
@@ -628,25 +895,54 @@ if __name__ == "__main__":
         default=120,
     )
 
+    parser.add_argument(
+        "--check-db",
+        help="verify in-memory download history matches the database "
+        "after each run (default: off)",
+        default=False,
+        action="store_true",
+    )
+
     args = parser.parse_args()
     config = args.config
 
-    runner = TVTorrentController(config, mode="scrape")
-    runner.selectNewEpisodes()
+    # A cron run only loads download history if upstream changed
+    runner = TVTorrentController(config, mode="scrape", loadHistory=args.forever)
+
+    if not args.forever:
+        # A token refresh started after this run's API listing finishes
+        # before we exit (even early), so the next run starts with it
+        atexit.register(runner.torrentController.finishRefresh)
+
+    if args.forever:
+        import asyncio
 
-    forever = args.forever
-    if forever:
+        asyncio.run(runForever(runner, args.interval, checkDB=args.check_db))
+    elif runner.upstreamUnchanged():
+        print("Nothing changed upstream since the last run")
 
-        def countdown(seconds):
-            print("")
-            for i in range(seconds, 0, -1):
-                print(" " * 44, end="\r")  # clear width of string below
-                print("{} seconds until next download attempt...".format(i), end="\r")
-                sys.stdout.flush()
-                time.sleep(1)
+        if runner.holdsDue():
+            runner.loadHistory()
+            runner.releaseDueHolds()
 
-        intervalToCheckForNewEpisodes = args.interval
+        # Downloads the torrent client refused last time don't wait for
+        # upstream to change
+        if runner.deliveriesDue():
+            runner.deliverQueued()
 
-        while True:
-            countdown(intervalToCheckForNewEpisodes)
+        runner.store.commit()
+    else:
+        runner.loadHistory()
+        try:
             runner.selectNewEpisodes()
+        except webScrapeFetch.CaptchaError as e:
+            print(e)
+            sys.exit(1)
+
+        # Even when other providers carried on, a captcha fails the run
+        failures = runner.listings.failures
+        if any(isinstance(e, webScrapeFetch.CaptchaError) for e in failures):
+            sys.exit(1)
+
+        if args.check_db and not runner.verifyDownloadIndex():
+            sys.exit(1)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import time
+
+
+class MagnetCache:
+    """ Persistent episode page URL -> magnet link cache.
+
+    Lives in the same DownloadStore as the download history so retries
+    (and restarts) of a previously resolved episode page don't need
+    another page fetch.
+
+    Entries older than 'maxAge' seconds are ignored and eventually evicted.
+    When more than 'maxEntries' rows exist, the oldest rows are evicted.
+    """
+
+    def __init__(self, store, maxEntries=5000, maxAge=7 * 24 * 60 * 60):
+        self.store = store
+        self.maxEntries = maxEntries
+        self.maxAge = maxAge
+
+    def get(self, url):
+        rows = self.store.query(
+            "SELECT magnet FROM magnets WHERE url=? AND fetchedAt >= ?",
+            (url, time.time() - self.maxAge),
+        )
+
+        return rows[0][0] if rows else None
+
+    def getMany(self, urls):
+        """ Return {url: magnet} for every url with a live cache entry """
+        found = {}
+        for url in urls:
+            magnet = self.get(url)
+            if magnet:
+                found[url] = magnet
+
+        return found
+
+    def putMany(self, links):
+        now = time.time()
+        self.store.executemany(
+            "INSERT OR REPLACE INTO magnets VALUES (?, ?, ?)",
+            ((url, magnet, now) for url, magnet in links.items() if magnet),
+        )
+
+    def evict(self):
+        # Age based eviction first...
+        self.store.execute(
+            "DELETE FROM magnets WHERE fetchedAt < ?", (time.time() - self.maxAge,)
+        )
+
+        # ...then trim to size by dropping the oldest entries
+        self.store.execute(
+            """DELETE FROM magnets WHERE url IN
+                  (SELECT url FROM magnets ORDER BY fetchedAt DESC
+                   LIMIT -1 OFFSET ?)""",
+            (self.maxEntries,),
+        )
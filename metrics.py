@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+
+# Upper bounds (seconds) for phase timing histograms
+PHASE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+
+def formatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in pairs) + "}"
+
+
+class Counter:
+    """ Monotonic counter, optionally split by labels """
+
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+
+        return [
+            "{}{} {}".format(self.name, formatLabels(key), value)
+            for key, value in sorted(values.items())
+        ]
+
+    def snapshot(self):
+        with self.lock:
+            return [[dict(key), value] for key, value in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    """ Value that can go up and down, optionally split by labels """
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram:
+    """ Cumulative bucket histogram (Prometheus style), split by labels """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=PHASE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = labelKey(labels)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if not counts:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+
+            counts[slot] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+
+        lines = []
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name, formatLabels(key, [("le", bound)]), cumulative
+                    )
+                )
+
+            lines.append("{}_sum{} {}".format(self.name, formatLabels(key), counts[-1]))
+            lines.append(
+                "{}_count{} {}".format(self.name, formatLabels(key), cumulative)
+            )
+
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+
+        return [
+            [
+                dict(key),
+                {
+                    "count": sum(counts[:-1]),
+                    "sum": counts[-1],
+                    "buckets": dict(zip(map(str, self.buckets + ("+Inf",)), counts)),
+                },
+            ]
+            for key, counts in sorted(values.items())
+        ]
+
+
+class Registry:
+    """ Every metric we export, by name """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=PHASE_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        """ Prometheus text exposition format """
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+
+        lines = []
+        for name, metric in metrics:
+            lines.append("# HELP {} {}".format(name, metric.help))
+            lines.append("# TYPE {} {}".format(name, metric.kind))
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+
+        return {name: metric.snapshot() for name, metric in metrics}
+
+    def writeJSON(self, filename):
+        """ Atomically replace 'filename' with a snapshot of every metric """
+        stats = {"updatedAt": time.time(), "metrics": self.snapshot()}
+        temporary = filename + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(stats, f, indent=1)
+
+        # Readers never see a half written file
+        os.replace(temporary, filename)
+
+    def serve(self, port, host=""):
+        """ Serve /metrics in the background on 'port' """
+        # Only daemons with a metrics port pay for importing the server
+        import http.server
+
+        registry = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Scrapes every few seconds would drown out our own output
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+registry = Registry()
+
+phaseSeconds = registry.histogram(
+    "gettv_phase_seconds", "Time spent in each selection phase"
+)
+cycleSeconds = registry.histogram(
+    "gettv_cycle_seconds", "Time spent in each full selection cycle"
+)
+httpRequests = registry.counter(
+    "gettv_http_requests_total", "HTTP requests made, by endpoint and status"
+)
+httpBytes = registry.counter(
+    "gettv_http_response_bytes_total", "HTTP response body bytes, by endpoint"
+)
+httpRetries = registry.counter(
+    "gettv_http_retries_total", "Failed requests that were retried, by endpoint"
+)
+captchaDetections = registry.counter(
+    "gettv_captcha_detections_total",
+    "Captcha or error pages served instead of listings, by source",
+)
+listings = registry.counter(
+    "gettv_listings_total",
+    "Listings seen, by outcome (skipped, matched, rejected, accepted, dispatched)",
+)
+
+
+def recordRequest(endpoint, fetch):
+    """ Return fetch() (a requests response), counting it under 'endpoint' """
+    start = time.perf_counter()
+    try:
+        r = fetch()
+    except Exception:
+        httpRequests.inc(endpoint=endpoint, status="error")
+        raise
+    finally:
+        phaseSeconds.observe(time.perf_counter() - start, phase="fetch")
+
+    httpRequests.inc(endpoint=endpoint, status=r.status_code)
+    httpBytes.inc(len(r.content), endpoint=endpoint)
+    return r
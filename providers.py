@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+import time
+import base64
+import queue
+import threading
+import contextlib
+import collections
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import webScrapeFetch
+
+WEEK = 7 * 24 * 60 * 60
+
+# Shows without a selection for this long are searched round robin instead
+# of by their (probably stale) weekly schedule
+DORMANT_AFTER = 5 * WEEK
+
+# Share of each cycle's searches kept for dormant (and newly added) shows
+# so a long list of active shows can't crowd them out
+DORMANT_SHARE = 0.25
+
+# Most scraped listings a shared fetch cache keeps (newest first) so fleet
+# instances that skipped a few cycles can still catch up
+SHARED_LISTINGS = webScrapeFetch.MAX_PAGES_BACK * 25
+
+# How often a provider waiting to hand over a batch checks whether the
+# consumer went away
+POLL_SECONDS = 0.5
+
+
+def infohashFromMagnet(magnetLink):
+    """ Return lowercase hex BitTorrent infohash from a magnet link (or None)
+
+    Magnet links carry the infohash as 'xt=urn:btih:<hash>' where the hash is
+    either 40 hex characters or 32 base32 characters.
+    """
+    if not magnetLink:
+        return None
+
+    query = urllib.parse.urlsplit(magnetLink).query
+    for xt in urllib.parse.parse_qs(query).get("xt", []):
+        if not xt.lower().startswith("urn:btih:"):
+            continue
+
+        infohash = xt[len("urn:btih:") :]
+        if len(infohash) == 40:
+            return infohash.lower()
+
+        if len(infohash) == 32:
+            try:
+                return base64.b32decode(infohash.upper()).hex()
+            except ValueError:
+                return None
+
+    return None
+
+
+class Listing(
+    collections.namedtuple("Listing", ["source", "filename", "magnet", "episodePage"])
+):
+    """ Provider-independent representation of one listed release.
+
+    Providers that list magnet links directly fill in 'magnet'; providers
+    that only link to a page with the magnet link fill in 'episodePage'
+    and the magnet link gets resolved later.
+    """
+
+    __slots__ = ()
+
+    @property
+    def infohash(self):
+        return infohashFromMagnet(self.magnet)
+
+
+class Provider:
+    """ A source of recently posted releases.
+
+    pages() yields lists of Listing, newest first, as they become available.
+    """
+
+    name = None
+
+    def pages(self):
+        raise NotImplementedError
+
+    def available(self):
+        """ False while retrying this provider would just fail fast """
+        return True
+
+    def acknowledge(self, unresolved):
+        """ Called once every batch from pages() has been processed, so
+        providers only remember how far they got when it's really done.
+        'unresolved' holds episode pages whose magnet links we couldn't get.
+        """
+
+    def newestPage(self):
+        """ Fetch only the newest listings (JSON serializable), so callers
+        can tell whether anything changed upstream. The next pages() starts
+        from what this fetched instead of fetching it again.
+
+        Returns None if this provider can't tell from one page.
+        """
+        return None
+
+
+class TorrentApiProvider(Provider):
+    name = "api"
+
+    def __init__(self, controller, sharedCache=None):
+        self.controller = controller
+        self.sharedCache = sharedCache
+        self.prefetched = None
+
+    def fetch(self, previous=None):
+        return [
+            (result["filename"], result["download"])
+            for result in self.controller.loadCurrentSearchResultsTV()
+        ]
+
+    def results(self):
+        if self.sharedCache:
+            return self.sharedCache.get(self.controller.BASE, self.fetch)
+
+        return self.fetch()
+
+    def newestPage(self):
+        # The API returns everything in one response anyway
+        self.prefetched = self.results()
+        return self.prefetched
+
+    def pages(self):
+        results, self.prefetched = self.prefetched, None
+        if results is None:
+            results = self.results()
+
+        # The API returns everything in one response, so it's one batch.
+        yield [
+            Listing(self.name, filename, magnet, None) for filename, magnet in results
+        ]
+
+    def available(self):
+        return self.controller.available()
+
+
+class TorrentApiSearchProvider(Provider):
+    """ Searches the API for each tracked show instead of reading the most
+    recent 100 listings, so busy nights can't push our shows out of view.
+
+    At most 'perCycle' shows are searched each cycle, 'concurrency' at a
+    time (all searches share the controller's token and rate limiter).
+    Shows are searched in order of when we expect a new episode: weekly
+    shows whose last selection was closest to a week (or a few moments)
+    ago go first. A share of every cycle (DORMANT_SHARE) goes to shows we
+    haven't seen in a while, never searched or least recently searched
+    first. Search times are kept in the database, so every show gets its
+    turn across cron runs too.
+    """
+
+    name = "search"
+
+    def __init__(self, controller, showList, store, perCycle=30, concurrency=2):
+        self.controller = controller
+        self.showList = showList
+        self.store = store
+        self.perCycle = perCycle
+        self.concurrency = concurrency
+
+    def available(self):
+        return self.controller.available(self.controller.SEARCH_ENDPOINT)
+
+    def searchOrder(self, shows):
+        """ Names from 'shows' (a ShowIndex) to search this cycle, in order """
+        names = list(dict.fromkeys(entry.canonical for entry in shows.entries))
+        activity = self.store.showActivity()
+        searched = self.store.showSearches()
+        now = time.time()
+
+        active = []
+        dormant = []
+        for name in names:
+            lastActiveAt = activity.get(name)
+            if lastActiveAt and now - lastActiveAt < DORMANT_AFTER:
+                # Time since this show's weekly slot last came around
+                active.append(((now - lastActiveAt) % WEEK, name))
+            else:
+                dormant.append((searched.get(name, 0), name))
+
+        # Each group gets its share; whatever one group can't use goes to
+        # the other (with one search per cycle, active shows win)
+        dormantSlots = 0
+        if self.perCycle > 1:
+            dormantSlots = min(len(dormant), max(1, int(self.perCycle * DORMANT_SHARE)))
+
+        activeSlots = min(len(active), self.perCycle - dormantSlots)
+        dormantSlots = min(len(dormant), self.perCycle - activeSlots)
+
+        order = [name for _, name in sorted(active)[:activeSlots]]
+        order += [name for _, name in sorted(dormant)[:dormantSlots]]
+        return order
+
+    def pages(self):
+        order = self.searchOrder(self.showList.current())
+        if not order:
+            return
+
+        failures = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            searches = {
+                pool.submit(self.controller.searchShow, name): name for name in order
+            }
+
+            for search in as_completed(searches):
+                name = searches[search]
+                self.store.recordSearch(name)
+
+                try:
+                    results = search.result()
+                except Exception as e:
+                    print("Search for {} failed: {}".format(name, e))
+                    failures.append(e)
+                    continue
+
+                yield [
+                    Listing(self.name, result["filename"], result["download"], None)
+                    for result in results
+                ]
+
+        if len(failures) == len(order):
+            raise failures[0]
+
+
+class ScrapeProvider(Provider):
+    name = "scrape"
+
+    def __init__(self, store, sharedCache=None):
+        self.store = store
+        self.sharedCache = sharedCache
+        self.prefetched = None
+
+        # Episode pages pages() listed (newest first) for acknowledge()
+        self.listed = []
+
+    def available(self):
+        return webScrapeFetch.available()
+
+    def newestPage(self):
+        if self.sharedCache:
+            self.prefetched = self.sharedCache.get(
+                webScrapeFetch.SHOWS_AT, self.fetchShared
+            )
+        else:
+            self.prefetched = webScrapeFetch.episodesFromIndexPage(1)
+
+        return self.prefetched
+
+    def pages(self):
+        source = webScrapeFetch.SHOWS_AT
+        lastSeen = self.store.lastSeen(source)
+        prefetched, self.prefetched = self.prefetched, None
+        self.listed = []
+
+        if self.sharedCache:
+            batches = self.sharedPages(source, lastSeen, prefetched)
+        else:
+            # The scraper yields each index page as soon as it's downloaded
+            # while later pages are still being fetched.
+            batches = (
+                [
+                    Listing(self.name, e["filename"], None, e["episodePage"])
+                    for e in episodes
+                ]
+                for episodes in webScrapeFetch.iterEpisodePages(
+                    lastSeen=lastSeen, firstPage=prefetched
+                )
+            )
+
+        for listings in batches:
+            self.listed.extend(listing.episodePage for listing in listings)
+            yield listings
+
+    def acknowledge(self, unresolved):
+        # Remember the newest entry only now so a cycle that fails part way
+        # re-scans the same range next time. Never move past an entry we
+        # couldn't resolve: the next cycle has to list it again to retry it
+        # (in fleet mode nobody else will).
+        listed = self.listed
+        failed = [i for i, page in enumerate(listed) if page in unresolved]
+        if failed:
+            listed = listed[failed[-1] + 1 :]
+
+        if listed:
+            self.store.recordLastSeen(webScrapeFetch.SHOWS_AT, listed[0])
+
+    def fetchShared(self, previous):
+        """ Extend the fleet's shared listing with anything newer """
+        previous = previous or []
+
+        # Whoever fetches stops paging at the newest entry the fleet has
+        fresh = []
+        for episodes in webScrapeFetch.iterEpisodePages(
+            lastSeen=previous[0][1] if previous else None
+        ):
+            fresh.extend((e["filename"], e["episodePage"]) for e in episodes)
+
+        seen = {page for _, page in fresh}
+        merged = fresh + [entry for entry in previous if entry[1] not in seen]
+        return merged[:SHARED_LISTINGS]
+
+    def sharedPages(self, source, lastSeen, shared=None):
+        """ Listings from the fleet's shared cache newer than our 'lastSeen' """
+        if shared is None:
+            shared = self.sharedCache.get(source, self.fetchShared)
+
+        listings = []
+        for filename, page in shared:
+            if page == lastSeen:
+                break
+
+            listings.append(Listing(self.name, filename, None, page))
+
+        if listings:
+            yield listings
+
+
+class ListingAggregator:
+    """ Query every provider concurrently and merge their listings.
+
+    Batches are yielded in the order they arrive from any provider, so the
+    fastest source sets the pace. The same torrent listed by several
+    providers (by infohash) is only yielded the first time it shows up.
+    A provider is acknowledged once the consumer has processed everything
+    it listed.
+    """
+
+    def __init__(self, providers):
+        self.providers = providers
+        self.seen = set()
+        self.lock = threading.Lock()
+
+        # Exceptions from providers that failed (even if others didn't)
+        self.failures = []
+
+        # Episode pages whose magnet links the consumer couldn't resolve
+        self.unresolvedPages = set()
+
+    def claim(self, infohash):
+        """ True the first time 'infohash' is claimed (or if unknown) """
+        if not infohash:
+            return True
+
+        with self.lock:
+            if infohash in self.seen:
+                return False
+
+            self.seen.add(infohash)
+            return True
+
+    def unresolved(self, listing):
+        """ Tell 'listing''s provider not to move past it this cycle """
+        with self.lock:
+            self.unresolvedPages.add(listing.episodePage)
+
+    def batches(self):
+        arrived = queue.Queue(maxsize=len(self.providers) * 2)
+        done = object()
+        closed = threading.Event()
+
+        def put(item):
+            # Give up once the consumer stopped reading instead of blocking
+            # this thread (and its provider's fetch pool) forever
+            while not closed.is_set():
+                try:
+                    arrived.put(item, timeout=POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        def run(provider):
+            try:
+                with contextlib.closing(provider.pages()) as pages:
+                    for batch in pages:
+                        if not put((provider, batch)):
+                            return
+            except Exception as e:
+                print("Provider {} failed: {!r}".format(provider.name, e))
+                put((provider, e))
+            finally:
+                put((provider, done))
+
+        for provider in self.providers:
+            threading.Thread(target=run, args=(provider,), daemon=True).start()
+
+        remaining = len(self.providers)
+        failures = self.failures
+        failed = set()
+        try:
+            while remaining:
+                provider, batch = arrived.get()
+                if batch is done:
+                    remaining -= 1
+
+                    # We only get here once the consumer asks for more, so
+                    # every batch this provider listed has been processed
+                    if provider not in failed:
+                        provider.acknowledge(self.unresolvedPages)
+                    continue
+
+                if isinstance(batch, Exception):
+                    failures.append(batch)
+                    failed.add(provider)
+                    continue
+
+                unique = [listing for listing in batch if self.claim(listing.infohash)]
+                if unique:
+                    yield unique
+        finally:
+            closed.set()
+
+        # Only give up on the cycle if every provider failed
+        if failures and len(failures) == len(self.providers):
+            raise failures[0]
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+import urllib.parse
+
+
+class TokenBucket:
+    """ Thread-safe token bucket rate limiter.
+
+    Tokens refill continuously at 'rate' per second up to 'burst' tokens.
+    Every request takes one token, so callers block just long enough to
+    keep the long term request rate at or below 'rate'.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updatedAt = time.monotonic()
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def configure(self, rate=None, burst=None):
+        with self.lock:
+            if rate:
+                self.rate = float(rate)
+            if burst:
+                self.burst = max(1, burst)
+                self.tokens = min(self.tokens, self.burst)
+
+    def acquire(self, background=False):
+        """ Take one token, waiting as long as needed.
+
+        'background' callers only get a token while nobody else is waiting
+        for one, so they never delay a request somebody is waiting on.
+        """
+        counted = False
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    elapsed = now - self.updatedAt
+                    self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                    self.updatedAt = now
+
+                    if self.tokens >= 1 and not (background and self.waiting):
+                        self.tokens -= 1
+                        return
+
+                    if not background and not counted:
+                        self.waiting += 1
+                        counted = True
+
+                    # Sleep only as long as needed for the next token to appear
+                    waitFor = max(1 - self.tokens, 1 if background else 0) / self.rate
+
+                time.sleep(waitFor)
+        finally:
+            if counted:
+                with self.lock:
+                    self.waiting -= 1
+
+
+class HostRateLimiter:
+    """ One TokenBucket per remote host so each upstream is limited
+    independently (episode pages and index pages on the same host still
+    share a single bucket). """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def configure(self, rate=None, burst=None):
+        with self.lock:
+            if rate:
+                self.rate = rate
+            if burst:
+                self.burst = burst
+
+            for bucket in self.buckets.values():
+                bucket.configure(rate=rate, burst=burst)
+
+    def bucketFor(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+
+            return self.buckets[host]
+
+    def acquire(self, url):
+        self.bucketFor(url).acquire()
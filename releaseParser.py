@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import re
+import collections
+import functools
+
+# Everything we know about a release after parsing its filename.
+# Still a tuple, so it can be unpacked or passed straight to sqlite.
+Release = collections.namedtuple(
+    "Release", ["show", "episode", "quality", "reencode", "uncensored", "westLive"]
+)
+
+# Show name is immediately before the S00E00 or date marker (2016.01.01)
+RELEASE_NAME = re.compile(r"(.*?)\.(\d\d\d\d|S\d\d)")
+
+# Every other field comes from one scan over the filename
+RELEASE_TOKENS = re.compile(
+    r"(?P<episode>S\d\dE\d\d)"
+    r"|(?P<date>\d\d\d\d\.\d\d\.\d\d)"
+    r"|(?P<quality>720|1080|2160)"
+    r"|(?P<reencode>REPACK|PROPER)"
+    r"|(?P<uncensored>(?i:UNCENSORED))"
+    r"|(?P<westLive>WEST\.FEED)"
+)
+
+# Filenames repeat across cycles (and we check each one more than once per
+# cycle), so remember recent parses.
+CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def parseRelease(filename):
+    """Extract metadata from filename.
+
+    On success, return a Release of extracted:
+        (show, episode, quality, reencode, uncensored, westLive)
+    On failure to decode filename to components, return None
+
+    Examples:
+    Adventure.Time.S07E02.Varmints.720p.HDTV.x264-W4F[rarbg]
+    The.Simpsons.S27E06.PROPER.720p.HDTV.x264-KILLERS[rarbg]
+    Stephen.Colbert.2016.09.01.Larry.Wilmore.720p.CBS.WEBRip.AAC2.0.x264-RTN
+    The.Simpsons.S27E21.WEST.FEED.720p.HDTV.x264-BATV[rartv]
+    Mr.Robot.S02E07.UNCENSORED.1080p.WEB.X264-DEFLATE[rartv]
+
+    Updated to verify these two filenames are detected as the same episode:
+    Will.and.Grace.S10E13.720p.HDTV.x264-LucidTV[rarbg]
+    Will.And.Grace.S10E13.iNTERNAL.720p.WEB.h264-BAMBOOZLE[rarbg]
+    """
+    nameMatch = RELEASE_NAME.match(filename)
+    if not nameMatch:
+        return None
+
+    episodeNumber = None
+    episodeDate = None
+
+    # quality is 480p by default because 480p downloads have no quality tag,
+    # so '480' is the default passthrough value. 720/1080 will override
+    # 'quality' because they get extracted from filename details.
+    # Also note: we don't have an explicit option for 540p, but 540p will
+    #            fallback to the 480p selector.
+    quality = None
+    reencode = 0
+    uncensored = False
+    westLive = False
+
+    for token in RELEASE_TOKENS.finditer(filename):
+        kind = token.lastgroup
+        if kind == "episode":
+            episodeNumber = episodeNumber or token.group()
+        elif kind == "date":
+            episodeDate = episodeDate or token.group()
+        elif kind == "quality":
+            quality = quality or int(token.group())
+        elif kind == "reencode":
+            # If filename is a re-encode (REPACK or PROPER), then it's okay
+            # to allow a duplicate selection of a previously seen episode
+            # because the old one is known to be bad/corrupt/improper.
+            # Sometimes there's a rare REPACK.PROPER and we'd need to
+            # redownload that one too.
+            reencode += 1
+        elif kind == "uncensored":
+            # Also download UNCENSORED episodes as new even if the episode
+            # has been previously downloaded. Typically gets posted a few days
+            # to a week after the original TV airing.
+            uncensored = True
+        elif kind == "westLive":
+            # If a show is live, they usually do two versions: one for
+            # the east coast and then again three hours later for the
+            # west coast tagged with WEST.FEED and the same episode number.
+            westLive = True
+
+    # Prefer episode numbers, but fall back to dates if that's all we have.
+    # If neither, not a single episode (e.g. a Show.Name.S03 season pack).
+    episode = episodeNumber or episodeDate
+    if not episode:
+        return None
+
+    # Convert show name dot delimiters back to spaces.
+    # We normalize 'show' case because we rely on the sqlite3
+    # uniqueness constaints to prevent duplicate downloads, but some
+    # episodes are posted multiple times with multiple cases.
+    show = nameMatch.group(1).replace(".", " ").title()
+
+    return Release(show, episode, quality or 480, reencode, uncensored, westLive)
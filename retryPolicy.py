@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import time
+import random
+import datetime
+import threading
+import email.utils
+
+import metrics
+
+
+class RetryableError(Exception):
+    """ A failure worth trying again, optionally with the server's
+    requested delay (Retry-After) in seconds. """
+
+    def __init__(self, message, retryAfter=None):
+        super().__init__(message)
+        self.retryAfter = retryAfter
+
+
+class BlockedError(Exception):
+    """ The endpoint answered, but with something we can't use (e.g. a
+    captcha page). Counts against its circuit breaker; never retried. """
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling an endpoint whose circuit is open. """
+
+    def __init__(self, endpoint, retryIn):
+        super().__init__(
+            "{} is unavailable; retrying in {:.0f} seconds".format(endpoint, retryIn)
+        )
+        self.endpoint = endpoint
+        self.retryIn = retryIn
+
+
+def retryAfterSeconds(response):
+    """ Seconds requested by a Retry-After header (delta or HTTP date) """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+
+class CircuitBreaker:
+    """ Stops calls to an endpoint after 'failureThreshold' consecutive
+    failures.
+
+    After 'resetAfter' seconds one trial call is let through (half open):
+    success closes the circuit again, failure reopens it for twice as long
+    (up to 'maxResetAfter').
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failureThreshold=5, resetAfter=60, maxResetAfter=1800):
+        self.failureThreshold = failureThreshold
+        self.baseResetAfter = resetAfter
+        self.resetAfter = resetAfter
+        self.maxResetAfter = maxResetAfter
+        self.failures = 0
+        self.openedAt = None
+        self.trialRunning = False
+        self.lock = threading.Lock()
+
+    def state(self):
+        with self.lock:
+            return self.stateLocked()
+
+    def stateLocked(self):
+        if self.openedAt is None:
+            return self.CLOSED
+
+        if time.monotonic() - self.openedAt < self.resetAfter:
+            return self.OPEN
+
+        return self.HALF_OPEN
+
+    def retryIn(self):
+        """ Seconds until the circuit lets a trial call through """
+        with self.lock:
+            if self.openedAt is None:
+                return 0
+            return max(0, self.openedAt + self.resetAfter - time.monotonic())
+
+    def allow(self):
+        with self.lock:
+            state = self.stateLocked()
+            if state == self.CLOSED:
+                return True
+
+            if state == self.HALF_OPEN and not self.trialRunning:
+                self.trialRunning = True
+                return True
+
+            return False
+
+    def cancelTrial(self):
+        """ Give up a trial call without a verdict (e.g. interrupted) """
+        with self.lock:
+            self.trialRunning = False
+
+    def recordSuccess(self):
+        with self.lock:
+            self.failures = 0
+            self.openedAt = None
+            self.trialRunning = False
+            self.resetAfter = self.baseResetAfter
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.trialRunning:
+                # Trial call failed; stay away for longer this time
+                self.trialRunning = False
+                self.resetAfter = min(self.maxResetAfter, self.resetAfter * 2)
+                self.openedAt = time.monotonic()
+            elif self.failures >= self.failureThreshold:
+                self.openedAt = time.monotonic()
+
+
+class RetryPolicy:
+    """ Retries calls with capped exponential backoff and full jitter,
+    honoring server Retry-After delays, with one CircuitBreaker per
+    endpoint so a dead upstream fails fast instead of stalling callers. """
+
+    def __init__(
+        self,
+        attempts=5,
+        baseDelay=1,
+        maxDelay=120,
+        failureThreshold=5,
+        resetAfter=60,
+        retryOn=(RetryableError, OSError),
+    ):
+        self.attempts = attempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.failureThreshold = failureThreshold
+        self.resetAfter = resetAfter
+        self.retryOn = retryOn
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def configure(self, attempts=None, maxDelay=None, failureThreshold=None):
+        if attempts:
+            self.attempts = attempts
+        if maxDelay:
+            self.maxDelay = maxDelay
+        if failureThreshold:
+            self.failureThreshold = failureThreshold
+
+            with self.lock:
+                for breaker in self.breakers.values():
+                    breaker.failureThreshold = failureThreshold
+
+    def breakerFor(self, endpoint):
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(
+                    self.failureThreshold, self.resetAfter
+                )
+
+            return self.breakers[endpoint]
+
+    def available(self, endpoint):
+        """ True unless 'endpoint' has an open circuit """
+        return self.breakerFor(endpoint).state() != CircuitBreaker.OPEN
+
+    def status(self):
+        """ Map of endpoint to (state, consecutive failures, retry in) """
+        with self.lock:
+            breakers = dict(self.breakers)
+
+        return {
+            endpoint: (breaker.state(), breaker.failures, breaker.retryIn())
+            for endpoint, breaker in breakers.items()
+        }
+
+    def delayFor(self, attempt, retryAfter=None):
+        delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+
+        if retryAfter is not None:
+            # Never retry sooner than the server asked us to
+            delay = max(delay, min(retryAfter, self.maxDelay))
+
+        return delay
+
+    def call(self, endpoint, fn):
+        """ Return fn(), retrying failures in 'retryOn'.
+
+        Raises CircuitOpenError if the endpoint's circuit is (or becomes)
+        open, or the last failure once all attempts are used up.
+        """
+        breaker = self.breakerFor(endpoint)
+
+        for attempt in range(self.attempts):
+            if not breaker.allow():
+                raise CircuitOpenError(endpoint, breaker.retryIn())
+
+            try:
+                result = fn()
+            except (KeyboardInterrupt, CircuitOpenError):
+                # No verdict on this endpoint (a nested endpoint may be open)
+                breaker.cancelTrial()
+                raise
+            except BlockedError:
+                # Asking again right away would just get blocked again
+                breaker.recordFailure()
+                raise
+            except self.retryOn as e:
+                breaker.recordFailure()
+
+                if attempt == self.attempts - 1:
+                    raise
+
+                metrics.httpRetries.inc(endpoint=endpoint)
+                delay = self.delayFor(attempt, getattr(e, "retryAfter", None))
+                print(
+                    "{} failed ({}); retrying in {:.1f} seconds".format(
+                        endpoint, e, delay
+                    )
+                )
+                time.sleep(delay)
+                continue
+            except Exception:
+                # The endpoint answered; the caller just didn't like it
+                breaker.recordSuccess()
+                raise
+
+            breaker.recordSuccess()
+            return result
+
+
+# Shared by every fetcher so the daemon can see all upstream state at once
+policy = RetryPolicy()
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import ctypes
+import ctypes.util
+import struct
+import platform
+
+from releaseParser import parseRelease
+
+# Format of a quality override is (example):
+# show name anything - 1080p
+QUALITY_OVERRIDE = re.compile(r"\s?-\s?(720|1080|2160)p")
+
+# Format of a hold-back override in minutes is (example):
+# show name anything ~30m
+HOLD_BACK = re.compile(r"\s?~\s?(\d+)m")
+
+# Marks the end of a trie path that spells out a complete show name
+TERMINAL = None
+
+
+class ShowEntry:
+    """ One name from the SHOWS file.
+
+    'name' is the lowercased name we match against, 'canonical' is the
+    first name on its line (aliases share their canonical entry's settings).
+    'holdBack' is this show's hold-back window in minutes (None if the
+    configured default applies).
+    """
+
+    __slots__ = ["name", "canonical", "exact", "quality", "holdBack"]
+
+    def __init__(self, name, canonical, exact=False, quality=None, holdBack=None):
+        self.name = name
+        self.canonical = canonical
+        self.exact = exact
+        self.quality = quality
+        self.holdBack = holdBack
+
+    def __repr__(self):
+        return "ShowEntry({!r}, exact={}, quality={}, holdBack={})".format(
+            self.name, self.exact, self.quality, self.holdBack
+        )
+
+
+class ShowIndex:
+    """ Character trie of show names for prefix matching release filenames.
+
+    Shows are matched by prefix, so "the sim" matches "The.Simpsons...".
+    Walking the trie visits each filename character at most once and we
+    keep every show name passed along the way, so when one show is a
+    prefix of another ("the office" vs "the office us") the longest
+    matching name wins.
+
+    A show ending in '$' only matches releases whose show name is exactly
+    that name, never a longer name it's a prefix of.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        node = self.root
+        for char in entry.name:
+            node = node.setdefault(char, {})
+
+        node[TERMINAL] = entry
+        self.entries.append(entry)
+
+    def match(self, filename):
+        """ Return ShowEntry matching 'filename' or None if no show matches """
+
+        # lower() because we want case insensitive matches and we already
+        # lower()'d the entire SHOWS list when we parsed it.
+        # Replacing dots because our show names are space delimited.
+        lowerFile = filename.replace(".", " ").lower()
+
+        found = []
+        node = self.root
+        for char in lowerFile:
+            node = node.get(char)
+            if node is None:
+                break
+
+            if TERMINAL in node:
+                found.append(node[TERMINAL])
+
+        # Longest name first; fall back to shorter prefixes if an exact
+        # match requirement rules out the longer name.
+        for entry in reversed(found):
+            if entry.exact:
+                release = parseRelease(filename)
+                if not release or release.show.lower() != entry.name:
+                    continue
+
+            return entry
+
+        return None
+
+
+def parseShowLine(line):
+    """ Return list of ShowEntry for one SHOWS line (one per alias).
+
+    Format (every part after the name is optional):
+        Show Name | Alias One | Alias Two - 1080p ~30m
+
+    A trailing '$' on a name disables prefix matching for that name.
+    """
+
+    # Show filenames won't have extraneous punctuation
+    # even if it's the proper canonical form of the show name,
+    # so strip filename-interfering punctuation
+    line = re.sub(r"['.]", "", line.rstrip())
+
+    # If show has a quality override identifier, remember it for every alias
+    # (and repair name for matching)
+    quality = None
+    if "-" in line:
+        foundOverride = QUALITY_OVERRIDE.search(line)
+        if foundOverride:
+            # Remove quality identifier from compare name
+            line = QUALITY_OVERRIDE.sub("", line)
+            quality = [int(foundOverride.group(1))]
+
+    # Same for a hold-back window
+    holdBack = None
+    foundHoldBack = HOLD_BACK.search(line)
+    if foundHoldBack:
+        line = HOLD_BACK.sub("", line)
+        holdBack = int(foundHoldBack.group(1))
+
+    entries = []
+    canonical = None
+    for name in line.split("|"):
+        # Allow for case insensitive name matches so users
+        # don't have to worry about names like "iZombie, ONeals"
+        name = name.strip().lower()
+        if not name:
+            continue
+
+        exact = name.endswith("$")
+        name = name.rstrip("$").rstrip()
+
+        canonical = canonical or name
+        entries.append(
+            ShowEntry(name, canonical, exact=exact, quality=quality, holdBack=holdBack)
+        )
+
+    return entries
+
+
+def loadShowIndex(filename):
+    """ Build a ShowIndex from a SHOWS file """
+    index = ShowIndex()
+    with open(filename, "r") as shows:
+        for line in shows:
+            # Allow blank lines and start-of-line comments
+            if line != "\n" and line[0] != "#":
+                for entry in parseShowLine(line):
+                    index.add(entry)
+
+    return index
+
+
+class InotifyWatch:
+    """ Minimal inotify watch (Linux only) on a directory for changes to
+    specific filenames. Raises OSError if inotify isn't available. """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, directory, names):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        mask = (
+            self.IN_MODIFY
+            | self.IN_ATTRIB
+            | self.IN_CLOSE_WRITE
+            | self.IN_MOVED_FROM
+            | self.IN_MOVED_TO
+            | self.IN_CREATE
+            | self.IN_DELETE
+        )
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+        self.names = {os.fsencode(name) for name in names}
+
+    def changed(self):
+        """ True if any watched name changed since the last call """
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+
+                if mask & self.IN_Q_OVERFLOW or name in self.names:
+                    changed = True
+
+
+class ShowListWatcher:
+    """ Cache the parsed ShowIndex for a SHOWS file, rebuilding it only
+    when SHOWS or SHOWS.local actually change.
+
+    On Linux we ask inotify whether either file changed so an unchanged
+    file costs no syscalls beyond one non-blocking read. Elsewhere (or if
+    inotify fails, or either file is a symlink whose target may live in
+    another directory) we compare stat() details every time instead.
+
+    A reload builds a complete new index before replacing the old one, so
+    shows and their quality overrides always change together. If the new
+    file can't be read, we keep using the previous index.
+    """
+
+    def __init__(self, showsFilename):
+        self.showsFilename = showsFilename
+        self.localFilename = showsFilename + ".local"
+        self.index = None
+        self.signature = None
+        self.watch = None
+
+        # Edits to a symlink's target don't show up in the directory we
+        # watch; rechecked whenever we look at the files themselves
+        self.linked = False
+
+        if platform.system() == "Linux":
+            directory = os.path.dirname(os.path.abspath(showsFilename))
+            names = [os.path.basename(self.showsFilename)]
+            names.append(os.path.basename(self.localFilename))
+            try:
+                self.watch = InotifyWatch(directory, names)
+            except (OSError, AttributeError, TypeError):
+                self.watch = None
+
+    def filename(self):
+        # if SHOWS.local exists, use it *instead* of SHOWS
+        # otherwise, use SHOWS directly (no additional extension added)
+        if os.path.isfile(self.localFilename):
+            return self.localFilename
+
+        return self.showsFilename
+
+    def current(self):
+        if self.index is not None and self.watch:
+            # Read events even when linked so they don't pile up
+            if not self.watch.changed() and not self.linked:
+                return self.index
+
+        self.linked = any(
+            os.path.islink(name) for name in (self.showsFilename, self.localFilename)
+        )
+
+        useFilename = self.filename()
+        try:
+            st = os.stat(useFilename)
+        except OSError:
+            if self.index is None:
+                raise
+
+            print("Can't read {}, using previous show list".format(useFilename))
+            return self.index
+
+        signature = (useFilename, st.st_ino, st.st_size, st.st_mtime_ns)
+        if signature != self.signature:
+            try:
+                index = loadShowIndex(useFilename)
+            except OSError:
+                if self.index is None:
+                    raise
+
+                print("Can't read {}, using previous show list".format(useFilename))
+                return self.index
+
+            self.index, self.signature = index, signature
+
+        return self.index
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+import contextlib
+import urllib.parse
+
+from operator import itemgetter
+
+import requests
+
+import metrics
+import rateLimit
+import debugCapture
+from retryPolicy import policy, RetryableError, retryAfterSeconds
+
+try:
+    import fcntl
+except ImportError:
+    # No file locking on Windows; processes just won't coordinate
+    fcntl = None
+
+# The API allows one request every two seconds (shared by every thread)
+REQUESTS_PER_SECOND = 0.5
+
+# Error code the API returns for searches (or lists) without results
+NO_RESULTS = 20
+
+# tokens are only valid for 15 minutes
+TOKEN_VALID_FOR = 15 * 60
+
+# Replace tokens in the background once they're this old so a listing
+# request never has to wait for a new one
+TOKEN_REFRESH_AFTER = 10 * 60
+
+
+class TokenCache:
+    """ API token persisted to a file so every getTV process (and every
+    cron run) shares one token instead of each requesting their own.
+
+    Readers take a shared lock; refreshers hold an exclusive lock across
+    the whole refresh so concurrent processes wait for one new token
+    instead of all requesting one.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=False):
+        with open(self.filename, "a+") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+            try:
+                yield f
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read(self, f):
+        """ Return (token, acquiredAt) from locked file 'f' """
+        f.seek(0)
+        try:
+            saved = json.load(f)
+            return saved["token"], saved["acquiredAt"]
+        except (ValueError, KeyError, TypeError):
+            return None, None
+
+    def write(self, f, token, acquiredAt):
+        f.seek(0)
+        f.truncate()
+        json.dump({"token": token, "acquiredAt": acquiredAt}, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def load(self):
+        try:
+            with self.locked() as f:
+                return self.read(f)
+        except OSError:
+            return None, None
+
+
+class TorrentApiController:
+    # Name for request metrics
+    ENDPOINT = "torrentapi.org"
+
+    # Circuit breaker names for the retry policy
+    TOKEN_ENDPOINT = "torrentapi/token"
+    LIST_ENDPOINT = "torrentapi/list"
+    SEARCH_ENDPOINT = "torrentapi/search"
+
+    def __init__(self, request, proxies={}, tokenCache=None):
+        # API docs: https://torrentapi.org/apidocs_v2.txt
+        self.BASE = "https://torrentapi.org/pubapi_v2.php?app_id=getTV&"
+        self.token = None
+        self.requestsFromSource = request  # must conform to 'requests' API
+        self.proxs = proxies
+        self.tokenAcquiredAt = None
+        self.rejectedToken = None
+        self.tokenCache = tokenCache
+        self.tokenLock = threading.Lock()
+        self.refreshing = threading.Event()
+        self.limiter = rateLimit.TokenBucket(REQUESTS_PER_SECOND)
+
+        # Set by getToken() once the token is old enough to replace; the
+        # refresh starts after the request that noticed goes out
+        self.refreshDue = False
+        self.refresher = None
+
+    def get(self, url, background=False):
+        # Background requests (token refreshes) never take the rate limit
+        # slot a listing request is waiting for
+        self.limiter.acquire(background)
+        try:
+            return metrics.recordRequest(
+                self.ENDPOINT,
+                lambda: self.requestsFromSource.get(
+                    url, proxies=self.proxs, timeout=(5, 5)
+                ),
+            )
+        finally:
+            if self.refreshDue and not background:
+                self.refreshTokenInBackground()
+
+    def invalidateToken(self):
+        self.token = None
+        self.tokenAcquiredAt = None
+
+    def rejectToken(self, token):
+        """ Stop using 'token' after the API refused it. It may still be in
+        the token cache, so remember it to never adopt it again. """
+        self.rejectedToken = token
+        if self.token == token:
+            self.invalidateToken()
+
+    def isTokenValid(self):
+        if self.token:
+            now = time.time()
+            tokenValid = (now - self.tokenAcquiredAt) < TOKEN_VALID_FOR
+
+            if tokenValid:
+                return True
+
+            self.invalidateToken()
+            return False
+        return False
+
+    def adoptToken(self, token, acquiredAt):
+        """ Use 'token' if it's valid and newer than the one we have """
+        if not token or time.time() - acquiredAt >= TOKEN_VALID_FOR:
+            return False
+
+        if token == self.rejectedToken:
+            return False
+
+        if self.token and self.tokenAcquiredAt >= acquiredAt:
+            return False
+
+        # Assign together so readers never see a mismatched pair for long
+        self.token, self.tokenAcquiredAt = token, acquiredAt
+        return True
+
+    def getToken(self):
+        if not self.isTokenValid() and self.tokenCache:
+            # Another process (or a previous run) may have a token for us
+            self.adoptToken(*self.tokenCache.load())
+
+        if self.isTokenValid():
+            if time.time() - self.tokenAcquiredAt > TOKEN_REFRESH_AFTER:
+                self.refreshDue = True
+
+            return self.token
+
+        # No usable token anywhere, so this is the one time we have to wait
+        return self.refreshToken()
+
+    def refreshToken(self, background=False):
+        """ Get a new token and share it through the token cache """
+        with self.tokenLock:
+            if not self.tokenCache:
+                return self.fetchToken(background)
+
+            with self.tokenCache.locked(exclusive=True) as f:
+                # Somebody else may have refreshed while we waited for the lock
+                # (unless it's the token the API just rejected)
+                token, acquiredAt = self.tokenCache.read(f)
+                fresh = token and time.time() - acquiredAt < TOKEN_REFRESH_AFTER
+                if fresh and token != self.rejectedToken:
+                    self.adoptToken(token, acquiredAt)
+                    return self.token
+
+                token = self.fetchToken(background)
+                self.tokenCache.write(f, token, self.tokenAcquiredAt)
+                return token
+
+    def refreshTokenInBackground(self):
+        self.refreshDue = False
+        if self.refreshing.is_set():
+            return
+
+        self.refreshing.set()
+
+        def refresh():
+            try:
+                self.refreshToken(background=True)
+            except Exception as e:
+                print("Background API token refresh failed:", e)
+            finally:
+                self.refreshing.clear()
+
+        self.refresher = threading.Thread(target=refresh, daemon=True)
+        self.refresher.start()
+
+    def finishRefresh(self):
+        """ Wait for a background token refresh to finish. Runs that exit
+        right after their listings call this so the refresh isn't lost
+        (and the next run doesn't have to wait for a token instead). """
+        if self.refresher:
+            self.refresher.join()
+
+    def keepTokenFresh(self):
+        """ Refresh the token before it gets old for as long as we run,
+        even if nothing asks for one (e.g. long daemon intervals). """
+
+        def refresher():
+            while True:
+                age = time.time() - (self.tokenAcquiredAt or 0)
+                if age >= TOKEN_REFRESH_AFTER:
+                    try:
+                        self.refreshToken(background=True)
+                    except Exception as e:
+                        print("API token refresh failed:", e)
+                        time.sleep(60)
+                    continue
+
+                time.sleep(TOKEN_REFRESH_AFTER - age)
+
+        threading.Thread(target=refresher, daemon=True).start()
+
+    def fetchToken(self, background=False):
+        """ Request a brand new token from the API """
+        TOKEN = {"get_token": "get_token"}
+        tokenURL = self.BASE + urllib.parse.urlencode(TOKEN)
+
+        def attempt():
+            r = self.get(tokenURL, background)
+            acquiredAt = time.time()
+
+            j = self.checkedJSON(r)
+            if "token" not in j:
+                raise RetryableError("no token in API response")
+
+            self.token, self.tokenAcquiredAt = j["token"], acquiredAt
+            return self.token
+
+        return policy.call(self.TOKEN_ENDPOINT, attempt)
+
+    def checkedJSON(self, r):
+        """ Return the JSON body of API response 'r' or raise RetryableError """
+        if r.status_code == requests.codes.too_many_requests:
+            raise RetryableError("too many requests", retryAfterSeconds(r))
+
+        if r.status_code != 200:
+            # The API is fronted by cloudflare. Sometimes cloudflare
+            # throws up a captcha, which is annoying on remote servers,
+            # rendering our automation useless when it happens.
+            # Capture the complete error page (see [debug] in tv.conf) so we
+            # know what failed.
+            # If you get stuck by a cloudflare captcha block on your server,
+            # look into using a proxy instead.  See configuration file
+            # options under [network].
+            metrics.captchaDetections.inc(source="api")
+            error = "HTTP {}".format(r.status_code)
+            debugCapture.ring.capture(r.url, r.status_code, r.text, error)
+            raise RetryableError(error, retryAfterSeconds(r))
+
+        try:
+            j = r.json()
+        except ValueError:
+            debugCapture.ring.capture(r.url, r.status_code, r.text, "bad JSON")
+            raise RetryableError("JSON parsing error: {}".format(r.text[:200]))
+
+        debugCapture.ring.capture(r.url, r.status_code, r.text)
+        return j
+
+    # There are only two media queries: tv and movies
+    def loadCurrentSearchResultsTV(self):
+        return self.loadCurrentSearchResults("tv")
+
+    def loadCurrentSearchResultsMovies(self):
+        return self.loadCurrentSearchResults("movies")
+
+    def loadCurrentSearchResults(self, category):
+        MOST_RECENT_100 = {
+            "mode": "list",
+            "category": category,
+            "sort": "last",
+            "limit": "100",
+        }
+
+        # Sort results from highest resolution to lowest resolution so
+        # if multiple downloads for the same release showing up at once,
+        # we'll trigger the higher quality download first.
+        # minor bug: only works with same-source, same-group releases.
+        #            if filename has multiple releases across multiple
+        #            groups, longer filename will sort after shorter
+        #            name regardless of prefix/resolution matching.
+        results = sorted(
+            self.query(MOST_RECENT_100, self.LIST_ENDPOINT), key=itemgetter("filename")
+        )
+
+        # We're consuming exactly the JSON returned by the API without
+        # any provider-independent intermediate representation.
+        # If the torrentapi.org return values change, we'll need to
+        # adjust how we use fields in other part of the code.
+        #
+        # We only use two fields from 'results' right now:
+        #   - 'filename'
+        #   - 'download' (the magnet link)
+        return results
+
+    def searchShow(self, show, category="tv"):
+        """ Most recent 100 results for 'show' (sorted like the list) """
+        SHOW_SEARCH = {
+            "mode": "search",
+            "search_string": show,
+            "category": category,
+            "sort": "last",
+            "limit": "100",
+        }
+
+        return sorted(
+            self.query(SHOW_SEARCH, self.SEARCH_ENDPOINT), key=itemgetter("filename")
+        )
+
+    def query(self, parameters, endpoint):
+        """ Return 'torrent_results' for one API request, with retries """
+
+        def attempt():
+            # Generate URL *inside* each attempt because if the token
+            # expires during an error condition, we need to generate a
+            # new token and a new URL instead of retrying with an
+            # expired token that'll never return new results.
+            token = self.getToken()
+            url = self.BASE + urllib.parse.urlencode(dict(parameters, token=token))
+
+            j = self.checkedJSON(self.get(url))
+
+            if j.get("error_code") == NO_RESULTS:
+                return []
+
+            # Manually check for token error because sometimes 15 minute tokens
+            # don't seem to last for 15 minutes.
+            if "error" in j:
+                self.rejectToken(token)
+                raise RetryableError(j["error"])
+
+            if "torrent_results" not in j:
+                raise RetryableError("torrent_results not found in JSON")
+
+            return j["torrent_results"]
+
+        return policy.call(endpoint, attempt)
+
+    def available(self, endpoint=LIST_ENDPOINT):
+        """ False while the API's circuit breakers are open """
+        return policy.available(self.TOKEN_ENDPOINT) and policy.available(endpoint)
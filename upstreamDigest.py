@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+
+
+def fileSignature(filename):
+    """ (size, mtime) of 'filename', or None if it doesn't exist """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+
+    return [st.st_size, st.st_mtime_ns]
+
+
+class UpstreamDigest:
+    """ Digest of what the last completed run saw, kept in a small file.
+
+    A run from cron compares the newest upstream listings (plus its own
+    SHOWS and config files) against it before doing anything expensive;
+    if nothing changed there's nothing new to select. The file is only
+    replaced once a run has delivered everything it accepted.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @staticmethod
+    def of(value):
+        """ Digest of any JSON serializable 'value' """
+        encoded = json.dumps(value, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def save(self, digest):
+        # Replace atomically so a concurrent run never reads half a digest
+        temporary = "{}.{}.tmp".format(self.filename, os.getpid())
+        try:
+            with open(temporary, "w") as f:
+                f.write(digest + "\n")
+
+            os.replace(temporary, self.filename)
+        except OSError as e:
+            print("Couldn't save upstream digest to", self.filename, e)
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 
 import requests
-import urllib.request
-from bs4 import BeautifulSoup
-import bs4.element
+from requests.adapters import HTTPAdapter
 
-import time
-import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+import collections
+import threading
+import html
+import re
+import urllib.parse
+
+import metrics
+import rateLimit
+import debugCapture
+from retryPolicy import policy, BlockedError, RetryableError, retryAfterSeconds
 
 BASE = "https://rarbg.to"
 SHOWS_AT = f"{BASE}/torrents.php?category=18;41"
@@ -14,6 +21,88 @@ NEXT_PAGE = "&page="
 
 PAGES_BACK = 4
 
+# Never page back further than this when catching up after downtime
+MAX_PAGES_BACK = 50
+
+# Maximum number of pages fetched at the same time
+CONCURRENCY = 4
+
+# Requests per second allowed per upstream host across *all* fetches from
+# this module. Replaces the fixed sleep after every request we used to have.
+REQUESTS_PER_SECOND = 2
+
+# Which HTML extraction backend to use:
+#   - "fast" scans <a> tags in a single regex pass without building a tree
+#   - "soup" builds a full BeautifulSoup html.parser tree (original method)
+PARSER = "fast"
+
+limiter = rateLimit.HostRateLimiter(REQUESTS_PER_SECOND, burst=CONCURRENCY)
+
+fakeHeader = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_5) AppleWebKit/603.2.4 (KHTML, like Gecko) Version/10.1.1 Safari/603.2.4",
+    "Cookies": "",  # You could paste your browser cookies here...
+}
+
+_session = None
+_sessionLock = threading.Lock()
+
+# EgressPool to fetch through instead of our own session (see configure())
+_egresses = None
+
+
+class CaptchaError(BlockedError):
+    """ An index page came back without listings (usually a captcha or
+    verification page instead) """
+
+
+def configure(concurrency=None, requestsPerSecond=None, parser=None, egresses=None):
+    """ Adjust fetch concurrency, rate limit, parser, and the EgressPool
+    requests go out through (e.g. from tv.conf) """
+    global CONCURRENCY, REQUESTS_PER_SECOND, PARSER, _session, _egresses
+
+    if egresses:
+        _egresses = egresses
+
+    if parser:
+        if parser not in EXTRACTORS:
+            raise ValueError("Unknown parser: {}".format(parser))
+
+        PARSER = parser
+
+    if concurrency:
+        CONCURRENCY = concurrency
+
+    if requestsPerSecond:
+        REQUESTS_PER_SECOND = requestsPerSecond
+
+    limiter.configure(rate=REQUESTS_PER_SECOND, burst=CONCURRENCY)
+
+    # Connection pool is sized by CONCURRENCY, so rebuild on next use
+    with _sessionLock:
+        _session = None
+
+
+def session():
+    """ Shared keep-alive session so we don't re-handshake on every page """
+    global _session
+
+    if _egresses:
+        # Each egress keeps its own keep-alive session
+        return _egresses
+
+    with _sessionLock:
+        if not _session:
+            s = requests.Session()
+            s.headers.update(fakeHeader)
+            # Index pages and episode pages can be in flight at the same
+            # time, each bounded by CONCURRENCY
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CONCURRENCY * 2)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _session = s
+
+        return _session
+
 
 def urlForIdx(pidx):
     return f"{SHOWS_AT}{NEXT_PAGE}{pidx}"
@@ -23,70 +112,282 @@ def urlForEpisode(part):
     return f"{BASE}{part}"
 
 
-def get(url):
-    print("Fetching", url)
+def endpointFor(url):
+    """ Circuit breaker name for 'url' (one per upstream host) """
+    return urllib.parse.urlsplit(url).netloc
+
+
+def available():
+    """ False while the scraper's upstream circuit breaker is open """
+    return policy.available(endpointFor(BASE))
+
+
+def get(url, extract=None):
+    """ Return the body of 'url', or extract(body) if given.
+
+    'extract' runs inside the retry policy's attempt, so it can raise
+    BlockedError for a page that loaded fine but is unusable (and have
+    that count against the host's circuit breaker).
+    """
+    endpoint = endpointFor(url)
+
+    def attempt():
+        limiter.acquire(url)
+
+        print("Fetching", url)
+
+        r = metrics.recordRequest(
+            endpoint, lambda: session().get(url, headers=fakeHeader, timeout=(5, 5))
+        )
 
-    fakeHeader = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_5) AppleWebKit/603.2.4 (KHTML, like Gecko) Version/10.1.1 Safari/603.2.4",
-        "Cookies": "", # You could paste your browser cookies here...
-    }
+        error = "HTTP {}".format(r.status_code) if r.status_code != 200 else None
+        debugCapture.ring.capture(url, r.status_code, r.text, error)
 
-    got = requests.get(url, timeout=(5, 5), headers=fakeHeader).text
-    time.sleep(0.5)  # rate limit
+        if r.status_code == 429 or r.status_code >= 500:
+            raise RetryableError("HTTP {}".format(r.status_code), retryAfterSeconds(r))
 
-    # Debug
-    with open(f"{time.process_time()}.html", "w") as gu:
-        gu.write(got)
+        return extract(r.text) if extract else r.text
 
-    return got
+    # Connection errors and overloaded responses back off and retry;
+    # a dead upstream trips the breaker so the rest of the cycle fails fast.
+    return policy.call(endpoint, attempt)
 
 
 def parse(response):
+    # Imported here so the default "fast" parser never loads BeautifulSoup
+    from bs4 import BeautifulSoup
+
     return BeautifulSoup(response, "html.parser")
 
 
-def magnetLinkFromURL(url):
-    pageText = get(url)
-    s = parse(pageText)
+# Opening <a> tag (quoted attribute values may contain '>', e.g. the overlib
+# popups on index pages embed whole <img> tags) plus any text right after it.
+ANCHOR = re.compile(r"""<a\s((?:[^>"']|"[^"]*"|'[^']*')*)>([^<]*)""", re.IGNORECASE)
+ATTRIBUTE = re.compile(
+    r"""([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+)))?"""
+)
+
+
+def anchorsFromHTML(response):
+    """ Yield (attributes, leadingText) for every <a> tag in 'response'.
+
+    'leadingText' is the text before the first child tag (if any), so an
+    empty 'leadingText' means the anchor starts with a sub-tag. """
+    for anchor in ANCHOR.finditer(response):
+        attributes = {}
+        for name, dquoted, squoted, bare in ATTRIBUTE.findall(anchor.group(1)):
+            value = dquoted or squoted or bare
+            attributes.setdefault(name.lower(), html.unescape(value))
+
+        yield attributes, anchor.group(2)
+
+
+def episodeLinksSoup(response):
+    import bs4.element
+
+    s = parse(response)
+
+    # Yes, this selector is weird because their page layout is multiple nested
+    # tables, so selecting by target value is easier than navigating tree DOM
+    torrentLinks = s.select('a[title][onmouseover][onmouseout][href^="/torrent/"]')
+
+    # The above selector also includes "recent movie" links, but we only want
+    # tv shows. Luckily the movie links are images, so elements with sub-tags
+    # are not episode links.
+    return [
+        (x["href"], str(x.contents[0]))
+        for x in torrentLinks
+        if x.contents and not isinstance(x.contents[0], bs4.element.Tag)
+    ]
 
-    torrentLinks = s.select('a[href^="magnet:"]')
+
+def episodeLinksFast(response):
+    links = []
+    for attributes, text in anchorsFromHTML(response):
+        # Same rules as the selector in episodeLinksSoup()...
+        if not (
+            "title" in attributes
+            and "onmouseover" in attributes
+            and "onmouseout" in attributes
+            and attributes.get("href", "").startswith("/torrent/")
+        ):
+            continue
+
+        # ...including skipping movie links (their first child is an <img>)
+        if not text:
+            continue
+
+        links.append((attributes["href"], html.unescape(text)))
+
+    return links
+
+
+def magnetLinkSoup(response):
+    torrentLinks = parse(response).select('a[href^="magnet:"]')
 
     # There *should* only be one magnet link on any given result page
     return torrentLinks[0]["href"]
 
 
-def fetchEpisodeList():
-    episodePage = []
-    for pidx in range(1, PAGES_BACK + 1):
-        # Get index page for page number requested...
-        url = urlForIdx(pidx)
-        response = get(url)
-        s = parse(response)
+def magnetLinkFast(response):
+    for attributes, _ in anchorsFromHTML(response):
+        href = attributes.get("href", "")
+        if href.startswith("magnet:"):
+            return href
 
-        # Yes, this selector is weird because their page layout is multiple nested
-        # tables, so selecting by target value is easier than navigating tree DOM
-        torrentLinks = s.select('a[title][onmouseover][onmouseout][href^="/torrent/"]')
+    raise IndexError("No magnet link found")
+
+
+EXTRACTORS = {
+    "fast": (episodeLinksFast, magnetLinkFast),
+    "soup": (episodeLinksSoup, magnetLinkSoup),
+}
+
+
+def episodeLinksFromHTML(response):
+    """ Return [(href, name)] for every tv episode link on an index page """
+    with metrics.phaseSeconds.time(phase="parse"):
+        return EXTRACTORS[PARSER][0](response)
+
+
+def magnetLinkFromHTML(response):
+    with metrics.phaseSeconds.time(phase="parse"):
+        return EXTRACTORS[PARSER][1](response)
+
+
+def magnetLinkFromURL(url):
+    return magnetLinkFromHTML(get(url))
+
+
+def magnetLinksFromURLs(urls):
+    """ Resolve magnet links for many episode pages in parallel.
+
+    Returns dict of {url: magnetLink}. Pages we failed to fetch or parse
+    map to None so one bad page doesn't lose the rest of the batch. """
+
+    def resolve(url):
+        try:
+            return magnetLinkFromURL(url)
+        except KeyboardInterrupt:
+            raise
+        except BaseException as e:
+            print("Failed to resolve magnet link for", url, e)
+            return None
+
+    urls = list(urls)
+    if not urls:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        return dict(zip(urls, pool.map(resolve, urls)))
+
+
+def episodesFromIndexPage(pidx):
+    # Get index page for page number requested...
+    url = urlForIdx(pidx)
+
+    def extract(response):
+        episodes = [
+            {"filename": name, "episodePage": urlForEpisode(href)}
+            for href, name in episodeLinksFromHTML(response)
+        ]
+
+        if not episodes:
+            # Usually a captcha or verification page instead of the listing
+            debugCapture.ring.capture(url, 200, response, "no listings")
+
+            # Paging past our usual depth can legitimately run off the end
+            # of the listing; anywhere before that we're being blocked
+            if pidx <= PAGES_BACK:
+                metrics.captchaDetections.inc(source="scrape")
+                raise CaptchaError(
+                    "No shows found on page {}! "
+                    "Did you get a verification/captcha/cookie error?".format(pidx)
+                )
+
+        return episodes
+
+    # Counts a captcha against the breaker so a blocked daemon skips cycles
+    # instead of fetching captchas every interval
+    return get(url, extract)
+
+
+def iterEpisodePages(lastSeen=None, firstPage=None):
+    """ Yield the episodes of each index page, newest page first.
+
+    Pages are fetched concurrently (up to CONCURRENCY in flight), but each
+    page is yielded as soon as it and all pages before it are ready so
+    callers can start processing page 1 while later pages download.
+
+    Without 'lastSeen' we fetch PAGES_BACK pages like always.
+
+    If 'lastSeen' (the newest episode page URL returned by a previous run)
+    is provided, we stop paging at the first page containing it, so a quiet
+    upstream costs one request per cycle. If 'lastSeen' isn't found within
+    PAGES_BACK pages, keep paging (up to MAX_PAGES_BACK) so we catch up on
+    everything posted while we weren't running.
+
+    'firstPage' is page 1's episodes if the caller already fetched them.
+    """
+
+    # Furthest page we're currently allowed to request. With a 'lastSeen'
+    # marker, check the first page alone; in steady state that's all we need.
+    limit = 1 if lastSeen else PAGES_BACK
+    nextPage = 1
+    inFlight = collections.deque()
+
+    if firstPage is not None:
+        done = Future()
+        done.set_result(firstPage)
+        inFlight.append((1, done))
+        nextPage = 2
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        try:
+            while True:
+                while len(inFlight) < CONCURRENCY and nextPage <= limit:
+                    inFlight.append(
+                        (nextPage, pool.submit(episodesFromIndexPage, nextPage))
+                    )
+                    nextPage += 1
+
+                if not inFlight:
+                    return
+
+                pidx, future = inFlight.popleft()
+                episodes = future.result()
+
+                if not episodes:
+                    # Only past PAGES_BACK (see episodesFromIndexPage())
+                    print("No shows found on page {}. Stopping.".format(pidx))
+                    return
+
+                yield episodes
+
+                if not lastSeen:
+                    continue
+
+                if any(e["episodePage"] == lastSeen for e in episodes):
+                    return
+
+                if pidx == limit and limit < MAX_PAGES_BACK:
+                    if limit >= PAGES_BACK:
+                        # Previously seen episode is still further back than
+                        # we looked, so we must have missed some cycles.
+                        print("Last seen episode not found yet, paging deeper...")
+                        limit = MAX_PAGES_BACK
+                    else:
+                        limit = PAGES_BACK
+        finally:
+            # Don't wait on pages nobody is going to read
+            for _, future in inFlight:
+                future.cancel()
 
-        # The above selector also includes "recent movie" links, but we only want
-        # tv shows. Luckily the movie links are images, so elements with sub-tags
-        # are not episode links.
-        showLinks = filter(
-            lambda x: not isinstance(x.contents[0], bs4.element.Tag), torrentLinks
-        )
 
-        if not showLinks:
-            print(
-                "No shows found on page! Did you get a verification/captcha/cookie error?"
-            )
-            sys.exit(1)
-
-        # For each episode we found, process based on our criteria
-        for show in showLinks:
-            name = show.contents[0]
-            resultPage = show["href"]
-            episodePage.append(
-                {"filename": name, "episodePage": urlForEpisode(resultPage)}
-            )
-
-    print("Full result:", episodePage)
-    return episodePage
+def fetchEpisodeList(lastSeen=None):
+    """ All episodes from iterEpisodePages() as one list """
+    return [
+        episode
+        for episodes in iterEpisodePages(lastSeen=lastSeen)
+        for episode in episodes
+    ]